@@ -0,0 +1,50 @@
+"""
+Compare two result files written by ``benchmarks.endpoint`` or
+``benchmarks.store``::
+
+    python -m benchmarks.compare before.json after.json
+"""
+from __future__ import division
+
+import json
+import sys
+
+
+METRICS = ["throughput", "p50_ms", "p95_ms", "p99_ms", "mean_ms", "queries_per_request"]
+
+
+def key(result):
+    return tuple(result.get(name) for name in ("flow", "transport", "operation", "rows"))
+
+
+def change(before, after):
+    if before is None or after is None:
+        return "n/a"
+    if not before:
+        return "{0:+.2f}".format(after - before)
+    return "{0:+.1f}%".format((after - before) / before * 100)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        sys.stderr.write("usage: python -m benchmarks.compare BEFORE.json AFTER.json\n")
+        return 2
+    with open(argv[0]) as fp:
+        before = json.load(fp)
+    with open(argv[1]) as fp:
+        after = json.load(fp)
+    sys.stdout.write("{0} -> {1}\n".format(before.get("revision"), after.get("revision")))
+    previous = dict((key(result), result) for result in before["results"])
+    for result in after["results"]:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        label = " ".join(str(part) for part in key(result) if part is not None)
+        changes = ["{0} {1}".format(metric, change(old.get(metric), result.get(metric))) for metric in METRICS if metric in result]
+        sys.stdout.write("{0:<40} {1}\n".format(label, "  ".join(changes)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
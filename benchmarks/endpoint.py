@@ -0,0 +1,297 @@
+"""
+End to end load benchmark for the OpenID endpoint.
+
+Drives ``identeco.urls`` with a scripted relying party, either in process
+through the Django test client or over HTTP through a local WSGI server, and
+reports throughput, latency percentiles and SQL queries per request for each
+flow::
+
+    python -m benchmarks.endpoint --iterations 500 --output results.json
+
+Compare two result files with ``python -m benchmarks.compare``.
+"""
+from __future__ import absolute_import, division
+
+import argparse
+import httplib
+import json
+import platform
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+from benchmarks.utils import git_revision, percentile, setup_django
+
+import django
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from openid.consumer.consumer import DiffieHellmanSHA1ConsumerSession, PlainTextConsumerSession
+from openid.message import Message, OPENID2_NS
+
+
+ENDPOINT = "/endpoint/"
+DECIDE = "/decide/"
+USERNAME = "benchmark"
+PASSWORD = "benchmark"
+
+
+def query_args(location):
+    return dict(urlparse.parse_qsl(urlparse.urlparse(location).query))
+
+
+class ClientTransport(object):
+
+    name = "client"
+
+    def __init__(self):
+        self.client = Client()
+        self.requests = 0
+        self.queries = 0
+
+    def login(self):
+        self.client.login(username=USERNAME, password=PASSWORD)
+
+    def request(self, method, path, data):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(path, data)
+        self.requests += 1
+        self.queries += len(queries.captured_queries)
+        return response.status_code, response.get("Location", ""), response.content
+
+    def get(self, path, data=None):
+        return self.request("get", path, data or {})
+
+    def post(self, path, data=None):
+        return self.request("post", path, data or {})
+
+    def close(self):
+        pass
+
+
+class QueryCountingApp(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.queries = 0
+
+    def __call__(self, environ, start_response):
+        with CaptureQueriesContext(connection) as queries:
+            result = self.app(environ, start_response)
+        self.queries += len(queries.captured_queries)
+        return result
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class WSGITransport(object):
+
+    name = "wsgi"
+
+    def __init__(self):
+        self.app = QueryCountingApp(WSGIHandler())
+        self.server = make_server("127.0.0.1", 0, self.app, handler_class=QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.connection = httplib.HTTPConnection("127.0.0.1", self.server.server_port)
+        self.cookie = ""
+        self.requests = 0
+
+    @property
+    def queries(self):
+        return self.app.queries
+
+    def login(self):
+        client = Client()
+        client.login(username=USERNAME, password=PASSWORD)
+        self.cookie = "{0}={1}".format(settings.SESSION_COOKIE_NAME, client.cookies[settings.SESSION_COOKIE_NAME].value)
+
+    def request(self, method, path, data):
+        headers = {"Cookie": self.cookie}
+        body = None
+        if method == "GET":
+            if data:
+                path = "{0}?{1}".format(path, urllib.urlencode(data))
+        else:
+            body = urllib.urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        content = response.read()
+        self.requests += 1
+        return response.status, response.getheader("Location", ""), content
+
+    def get(self, path, data=None):
+        return self.request("GET", path, data or {})
+
+    def post(self, path, data=None):
+        return self.request("POST", path, data or {})
+
+    def close(self):
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RelyingParty(object):
+    # A scripted relying party that speaks OpenID 2.0 to the endpoint using
+    # python-openid's consumer side session and message classes.
+
+    trusted_realm = "http://trusted.example.com/"
+    realm = "http://rp.example.com/"
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def check(self, condition, message):
+        if not condition:
+            raise AssertionError(message)
+
+    def associate(self, session_type):
+        session = {
+            "DH-SHA1": DiffieHellmanSHA1ConsumerSession,
+            "no-encryption": PlainTextConsumerSession,
+        }[session_type]()
+        args = {
+            "openid.ns": OPENID2_NS,
+            "openid.mode": "associate",
+            "openid.assoc_type": "HMAC-SHA1",
+            "openid.session_type": session_type,
+        }
+        for key, value in session.getRequest().items():
+            args["openid." + key] = value
+        status, _, content = self.transport.post(ENDPOINT, args)
+        self.check(status == 200, "associate returned {0}".format(status))
+        self.check(session.extractSecret(Message.fromKVForm(content)), "associate returned no secret")
+
+    def checkid_args(self, mode, realm):
+        return {
+            "openid.ns": OPENID2_NS,
+            "openid.mode": mode,
+            "openid.claimed_id": "http://specs.openid.net/auth/2.0/identifier_select",
+            "openid.identity": "http://specs.openid.net/auth/2.0/identifier_select",
+            "openid.realm": realm,
+            "openid.return_to": realm + "return/",
+        }
+
+    def checkid_immediate(self):
+        status, location, _ = self.transport.get(ENDPOINT, self.checkid_args("checkid_immediate", self.trusted_realm))
+        args = query_args(location)
+        self.check(args.get("openid.mode") == "id_res", "checkid_immediate was not answered positively")
+        return args
+
+    def checkid_setup(self):
+        status, location, _ = self.transport.get(ENDPOINT, self.checkid_args("checkid_setup", self.realm))
+        self.check(urlparse.urlparse(location).path == DECIDE, "checkid_setup was not sent to the decide page")
+        status, _, _ = self.transport.get(DECIDE)
+        self.check(status == 200, "decide page returned {0}".format(status))
+        status, location, _ = self.transport.post(DECIDE, {"trust_root": self.realm, "allow": "1"})
+        self.check(query_args(location).get("openid.mode") == "id_res", "checkid_setup was not answered positively")
+
+    def check_authentication(self, assertion):
+        args = dict(assertion, **{"openid.mode": "check_authentication"})
+        status, _, content = self.transport.post(ENDPOINT, args)
+        self.check("is_valid:true" in content, "check_authentication did not validate the assertion")
+
+
+def prepare(transport):
+    from django.contrib.auth.models import User
+    from identeco.models import Trust
+
+    user, created = User.objects.get_or_create(username=USERNAME)
+    user.set_password(PASSWORD)
+    user.save()
+    Trust.objects.get_or_create(user=user, trust_root=RelyingParty.trusted_realm, defaults={"always_trust": True})
+    transport.login()
+
+
+def run_flow(transport, name, flow, iterations):
+    latencies = []
+    requests, queries = transport.requests, transport.queries
+    start = time.time()
+    for i in xrange(iterations):
+        flow_start = time.time()
+        flow(i)
+        latencies.append(time.time() - flow_start)
+    elapsed = time.time() - start
+    requests, queries = transport.requests - requests, transport.queries - queries
+    return {
+        "flow": name,
+        "transport": transport.name,
+        "iterations": iterations,
+        "requests": requests,
+        "seconds": elapsed,
+        "throughput": iterations / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "queries_per_request": queries / requests if requests else None,
+    }
+
+
+def run(transport, iterations):
+    prepare(transport)
+    rp = RelyingParty(transport)
+    # check_authentication consumes the assertion it verifies, so collect
+    # fresh stateless assertions up front.
+    assertions = [rp.checkid_immediate() for i in xrange(iterations)]
+    flows = [
+        ("associate_dh_sha1", lambda i: rp.associate("DH-SHA1")),
+        ("associate_no_encryption", lambda i: rp.associate("no-encryption")),
+        ("checkid_immediate", lambda i: rp.checkid_immediate()),
+        ("checkid_setup", lambda i: rp.checkid_setup()),
+        ("check_authentication", lambda i: rp.check_authentication(assertions[i])),
+    ]
+    return [run_flow(transport, name, flow, iterations) for name, flow in flows]
+
+
+def print_results(results, stream=sys.stdout):
+    columns = "{flow:<24} {transport:<7} {throughput:>9.1f}/s {p50_ms:>8.2f} {p95_ms:>8.2f} {p99_ms:>8.2f} {queries_per_request:>6.1f}\n"
+    stream.write("{0:<24} {1:<7} {2:>11} {3:>8} {4:>8} {5:>8} {6:>6}\n".format("flow", "via", "throughput", "p50 ms", "p95 ms", "p99 ms", "sql/r"))
+    for result in results:
+        stream.write(columns.format(**result))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the identeco OpenID endpoint end to end.")
+    parser.add_argument("--iterations", type=int, default=200, help="iterations per flow")
+    parser.add_argument("--transport", choices=["client", "wsgi", "both"], default="both")
+    parser.add_argument("--output", help="write machine readable results to this JSON file")
+    args = parser.parse_args(argv)
+
+    setup_django()
+    transports = {"client": [ClientTransport], "wsgi": [WSGITransport], "both": [ClientTransport, WSGITransport]}[args.transport]
+    results = []
+    for transport_class in transports:
+        transport = transport_class()
+        try:
+            results.extend(run(transport, args.iterations))
+        finally:
+            transport.close()
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "store": settings.IDENTECO_STORE,
+                "server": settings.IDENTECO_SERVER,
+                "results": results,
+            }, fp, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+
+SECRET_KEY = "identeco-benchmarks"
+DEBUG = False
+ALLOWED_HOSTS = ["*"]
+
+USE_TZ = True
+TIME_ZONE = "UTC"
+
+DATABASES = {
+    "default": {
+        "ENGINE": os.environ.get("IDENTECO_BENCHMARK_DB_ENGINE", "django.db.backends.sqlite3"),
+        "NAME": os.environ.get("IDENTECO_BENCHMARK_DB_NAME", os.path.join(tempfile.gettempdir(), "identeco-benchmarks.sqlite3")),
+    }
+}
+
+INSTALLED_APPS = [
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+    "django.contrib.sessions",
+    "identeco",
+]
+
+MIDDLEWARE_CLASSES = [
+    "django.contrib.sessions.middleware.SessionMiddleware",
+    "django.contrib.auth.middleware.AuthenticationMiddleware",
+]
+
+TEMPLATE_CONTEXT_PROCESSORS = [
+    "django.contrib.auth.context_processors.auth",
+    "django.core.context_processors.request",
+]
+
+ROOT_URLCONF = "benchmarks.urls"
+
+PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+
+IDENTECO_STORE = os.environ.get("IDENTECO_STORE", "identeco.store.DjangoORMStore")
+IDENTECO_SERVER = os.environ.get("IDENTECO_SERVER", "openid.server.server.Server")
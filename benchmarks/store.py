@@ -0,0 +1,235 @@
+"""
+Data scale benchmark for the store and trust lookups.
+
+Fills the ``Association``, ``Nonce`` and ``Trust`` tables with synthetic rows
+spread over many server URLs and users, then measures the store operations
+and the trust lookup at each table size, giving a scaling curve per
+operation::
+
+    python -m benchmarks.store --rows 10000,1000000,10000000 --output store.json
+
+The database is selected with ``IDENTECO_BENCHMARK_DB_ENGINE`` and
+``IDENTECO_BENCHMARK_DB_NAME``. Tables are topped up between sizes, so the
+sizes must be given in increasing order.
+"""
+from __future__ import absolute_import, division
+
+import argparse
+import base64
+import binascii
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+from benchmarks.utils import git_revision, percentile, setup_django
+
+import django
+from django.db import connection, transaction
+
+from openid.association import Association as OpenIDAssociation
+from openid.store.nonce import SKEW
+
+
+CHUNK_SIZE = 10000
+
+
+class DataGenerator(object):
+    # Generates realistic looking rows: associations and nonces spread over
+    # server_urls, trust roots spread over users, and a share of expired rows
+    # for the cleanup methods to find. Ids start with a random prefix per run,
+    # so a run against a database filled by an earlier one does not collide
+    # with its handles, salts, usernames and trust roots.
+
+    def __init__(self, server_urls, expired, seed=0):
+        self.random = random.Random(seed)
+        self.server_urls = ["https://rp{0}.example.com/openid/server/".format(i) for i in xrange(server_urls)]
+        self.expired = expired
+        self.prefix = binascii.hexlify(os.urandom(4))
+        self.counter = 0
+
+    def next_id(self):
+        self.counter += 1
+        return "{0}{1:x}".format(self.prefix, self.counter)
+
+    def timestamp(self):
+        now = int(time.time())
+        if self.random.random() < self.expired:
+            return now - 2 * SKEW - self.random.randint(0, SKEW)
+        return now - self.random.randint(0, SKEW // 2)
+
+    def associations(self, count):
+        from identeco.models import Association, hash_server_url
+        from identeco.store import timestamp_to_datetime
+
+        for i in xrange(count):
+            server_url = self.random.choice(self.server_urls)
+            lifetime = 14 * 24 * 60 * 60 if self.random.random() >= self.expired else 60
+            issued = timestamp_to_datetime(self.timestamp())
+            yield Association(
+                type="HMAC-SHA1",
+                server_url=server_url,
+                server_url_hash=hash_server_url(server_url),
+                handle="{{HMAC-SHA1}}{{{0}}}".format(self.next_id()),
+                secret=base64.b64encode(os.urandom(20)),
+                lifetime=lifetime,
+                issued=issued,
+                expires=issued + datetime.timedelta(seconds=lifetime),
+            )
+
+    def nonces(self, count):
+        from identeco.models import Nonce, hash_server_url, nonce_bucket
+        from identeco.store import timestamp_to_datetime
+
+        for i in xrange(count):
+            server_url = self.random.choice(self.server_urls)
+            timestamp = self.timestamp()
+            issued = timestamp_to_datetime(timestamp)
+            yield Nonce(
+                server_url=server_url,
+                server_url_hash=hash_server_url(server_url),
+                salt=self.next_id(),
+                issued=issued,
+                expires=issued + datetime.timedelta(seconds=SKEW),
+                bucket=nonce_bucket(timestamp),
+            )
+
+    def users(self, count):
+        from django.contrib.auth.models import User
+
+        for i in xrange(count):
+            yield User(username="user{0}".format(self.next_id()), password="!")
+
+    def trusts(self, count, user_ids):
+        from identeco.models import Trust
+
+        for i in xrange(count):
+            yield Trust(
+                user_id=self.random.choice(user_ids),
+                trust_root="https://rp{0}.example.com/".format(self.next_id()),
+                always_trust=self.random.random() < 0.5,
+            )
+
+
+def bulk_insert(model, objects):
+    chunk = []
+    for obj in objects:
+        chunk.append(obj)
+        if len(chunk) == CHUNK_SIZE:
+            with transaction.atomic():
+                model.objects.bulk_create(chunk)
+            chunk = []
+    if chunk:
+        with transaction.atomic():
+            model.objects.bulk_create(chunk)
+
+
+def fill(generator, rows):
+    from django.contrib.auth.models import User
+    from identeco.models import Association, Nonce, Trust
+
+    bulk_insert(Association, generator.associations(max(0, rows - Association.objects.count())))
+    bulk_insert(Nonce, generator.nonces(max(0, rows - Nonce.objects.count())))
+    users = max(1, rows // 10)
+    bulk_insert(User, generator.users(max(0, users - User.objects.count())))
+    user_ids = list(User.objects.values_list("pk", flat=True))
+    bulk_insert(Trust, generator.trusts(max(0, rows - Trust.objects.count()), user_ids))
+
+
+def measure(operation, rows, samples, call):
+    latencies = []
+    for i in xrange(samples):
+        start = time.time()
+        call(i)
+        latencies.append(time.time() - start)
+    return {
+        "operation": operation,
+        "rows": rows,
+        "samples": samples,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+    }
+
+
+def run(generator, rows, samples):
+    from django.contrib.auth.models import User
+    from identeco.models import Association, Trust
+    from identeco.store import DjangoORMStore
+
+    store = DjangoORMStore()
+    rng = random.Random(rows)
+    existing = list(Association.objects.order_by("?").values_list("server_url", "handle")[:samples])
+    user_ids = list(User.objects.order_by("?").values_list("pk", flat=True)[:samples])
+    now = int(time.time())
+    results = [
+        measure("getAssociation", rows, samples, lambda i: store.getAssociation(*existing[i % len(existing)])),
+        measure("getAssociation_latest", rows, samples, lambda i: store.getAssociation(existing[i % len(existing)][0])),
+        measure("useNonce", rows, samples, lambda i: store.useNonce(rng.choice(generator.server_urls), now, "bench{0}".format(generator.next_id()))),
+        measure("storeAssociation", rows, samples, lambda i: store.storeAssociation(
+            rng.choice(generator.server_urls),
+            OpenIDAssociation.fromExpiresIn(3600, "bench{0}".format(generator.next_id()), "x" * 20, "HMAC-SHA1"),
+        )),
+        measure("trust_lookup", rows, samples, lambda i: list(
+            Trust.objects.filter(user_id=user_ids[i % len(user_ids)], always_trust=True).values_list("trust_root", flat=True)
+        )),
+    ]
+    for operation in ["cleanupAssociations", "cleanupNonces"]:
+        start = time.time()
+        purged = getattr(store, operation)()
+        elapsed = time.time() - start
+        results.append({
+            "operation": operation,
+            "rows": rows,
+            "samples": 1,
+            "purged": purged,
+            "mean_ms": elapsed * 1000,
+            "p50_ms": elapsed * 1000,
+            "p95_ms": elapsed * 1000,
+        })
+    return results
+
+
+def print_results(results, stream=sys.stdout):
+    baseline = {}
+    stream.write("{0:<24} {1:>10} {2:>10} {3:>10} {4:>10} {5:>8}\n".format("operation", "rows", "mean ms", "p50 ms", "p95 ms", "growth"))
+    for result in results:
+        first = baseline.setdefault(result["operation"], result)
+        growth = result["mean_ms"] / first["mean_ms"] if first["mean_ms"] else 0
+        stream.write("{operation:<24} {rows:>10} {mean_ms:>10.3f} {p50_ms:>10.3f} {p95_ms:>10.3f} ".format(**result))
+        stream.write("{0:>7.2f}x\n".format(growth))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the identeco store against large tables.")
+    parser.add_argument("--rows", default="10000,1000000,10000000", help="comma separated table sizes, in increasing order")
+    parser.add_argument("--samples", type=int, default=200, help="measurements per operation and size")
+    parser.add_argument("--server-urls", type=int, default=1000, help="number of distinct server_urls")
+    parser.add_argument("--expired", type=float, default=0.05, help="share of generated rows that are expired")
+    parser.add_argument("--output", help="write machine readable results to this JSON file")
+    args = parser.parse_args(argv)
+
+    setup_django()
+    generator = DataGenerator(args.server_urls, args.expired)
+    results = []
+    for rows in sorted(int(size) for size in args.rows.split(",")):
+        fill(generator, rows)
+        results.extend(run(generator, rows, args.samples))
+    results.sort(key=lambda result: (result["operation"], result["rows"]))
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+                "results": results,
+            }, fp, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
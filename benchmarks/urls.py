@@ -0,0 +1,7 @@
+from django.conf.urls import patterns, include, url
+
+
+urlpatterns = patterns(
+    "",
+    url(r"^", include("identeco.urls")),
+)
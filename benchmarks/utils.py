@@ -0,0 +1,31 @@
+from __future__ import division
+
+import os
+import subprocess
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+import django  # noqa
+from django.core.management import call_command  # noqa
+
+
+def setup_django():
+    if hasattr(django, "setup"):
+        django.setup()
+        call_command("migrate", interactive=False, verbosity=0)
+    else:
+        call_command("syncdb", interactive=False, verbosity=0)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[int(round(pct / 100 * (len(values) - 1)))]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
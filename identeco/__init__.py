@@ -1 +1,3 @@
 __version__ = "0.3.1"
+
+default_app_config = "identeco.apps.IdentecoConfig"
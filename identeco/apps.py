@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class IdentecoConfig(AppConfig):
+
+    name = "identeco"
+
+    def ready(self):
+        from identeco.registry import registry
+        # The claims provider invalidates its cache from model signals, build
+        # it now so every process, not only those serving OpenID, sends them.
+        registry.get_claims_provider()
@@ -0,0 +1,120 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+try:
+    from django.apps import apps
+except ImportError:
+    from django.db.models import get_model
+else:
+    get_model = apps.get_model
+
+from identeco.utils import get_cache
+
+
+class ClaimsProvider(object):
+    # Loads every claim about a user in one query and caches them per user as
+    # one bundle, so a positive assertion costs the same number of queries no
+    # matter how many fields the relying party asks for. Subclass it to release
+    # fields kept on profile models:
+    #
+    #     class ProfileClaimsProvider(ClaimsProvider):
+    #         fields = dict(ClaimsProvider.fields, country="profile.country")
+    #         select_related = ["profile"]
+    #         dependencies = {"profiles.Profile": "user_id"}
+
+    # Maps a claim to a dotted attribute path on the user, callables are called.
+    fields = {
+        "nickname": "username",
+        "email": "email",
+        "fullname": "get_full_name",
+    }
+    select_related = []
+    prefetch_related = []
+    # Maps a model label to the attribute holding the user id on its instances.
+    # Saving or deleting one invalidates that user's claims.
+    dependencies = {}
+    key_prefix = "identeco:claims"
+
+    def __init__(self):
+        self.senders = None
+
+    def get_cache(self):
+        return get_cache(getattr(settings, "IDENTECO_CLAIMS_CACHE_ALIAS", "default"))
+
+    def make_key(self, user_id):
+        return "{0}:{1}".format(self.key_prefix, user_id)
+
+    def get_queryset(self):
+        return get_user_model()._default_manager.select_related(*self.select_related).prefetch_related(*self.prefetch_related)
+
+    def get_value(self, obj, path):
+        for attr in path.split("."):
+            if obj is None:
+                return None
+            obj = getattr(obj, attr, None)
+            if callable(obj):
+                obj = obj()
+        return obj
+
+    def load(self, user):
+        if self.select_related or self.prefetch_related:
+            user = self.get_queryset().get(pk=user.pk)
+        claims = {}
+        for field, path in self.fields.iteritems():
+            value = self.get_value(user, path)
+            if value not in (None, ""):
+                claims[field] = value
+        return claims
+
+    def get_claims(self, user, fields=None):
+        if not (self.select_related or self.prefetch_related):
+            # Loading from the user at hand costs no query, the cache would.
+            claims = self.load(user)
+        else:
+            cache = self.get_cache()
+            key = self.make_key(user.pk)
+            claims = cache.get(key)
+            if claims is None:
+                claims = self.load(user)
+                cache.set(key, claims, getattr(settings, "IDENTECO_CLAIMS_CACHE_TIMEOUT", 3600))
+        if fields is None:
+            return claims
+        return dict((field, claims[field]) for field in fields if field in claims)
+
+    def get_senders(self):
+        if self.senders is None:
+            senders = {get_user_model(): "pk"}
+            for label, attr in self.dependencies.iteritems():
+                senders[get_model(*label.split("."))] = attr
+            self.senders = senders
+        return self.senders
+
+    def get_user_id(self, sender, instance):
+        attr = self.get_senders().get(sender)
+        if attr is None:
+            return None
+        return self.get_value(instance, attr)
+
+    def invalidate(self, user_id):
+        self.get_cache().delete(self.make_key(user_id))
+
+    def invalidate_instance(self, sender, instance, **kwargs):
+        # Logging in saves the user with update_fields=["last_login"], which
+        # changes no claim.
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and set(update_fields) <= set(["last_login"]):
+            return
+        user_id = self.get_user_id(sender, instance)
+        if user_id is not None:
+            self.invalidate(user_id)
+
+    def connect(self):
+        # Only the models the claims depend on send to the provider.
+        for sender in self.get_senders():
+            post_save.connect(self.invalidate_instance, sender=sender, weak=False)
+            post_delete.connect(self.invalidate_instance, sender=sender, weak=False)
+
+    def disconnect(self):
+        for sender in self.get_senders():
+            post_save.disconnect(self.invalidate_instance, sender=sender)
+            post_delete.disconnect(self.invalidate_instance, sender=sender)
@@ -0,0 +1,91 @@
+import collections
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
+
+from identeco.utils import setting_changed
+
+
+class DocumentCache(object):
+    # A bounded LRU map for precomputed discovery documents and URLs, which
+    # only depend on the host, the username and settings.
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+documents = DocumentCache(
+    max_size=getattr(settings, "IDENTECO_DISCOVERY_CACHE_SIZE", 1000),
+)
+
+
+def clear_documents(sender, setting, **kwargs):
+    if setting.startswith("IDENTECO_"):
+        documents.clear()
+
+
+setting_changed.connect(clear_documents)
+
+
+def get_xrds_url(request, username=None):
+    key = ("xrds_url", request.is_secure(), request.get_host(), username)
+    url = documents.get(key)
+    if url is None:
+        if username is not None:
+            url = reverse("identeco_identity_xrds", kwargs={"username": username})
+        else:
+            url = reverse("identeco_xrds")
+        url = request.build_absolute_uri(url)
+        documents.set(key, url)
+    return url
+
+
+def make_etag(content):
+    return '"{0}"'.format(hashlib.md5(content).hexdigest())
+
+
+def conditional_response(request, content, last_modified, cache_control, content_type=None, etag=None):
+    if etag is None:
+        etag = make_etag(content)
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        not_modified = etag in tags or "*" in tags
+    elif last_modified is not None:
+        if_modified_since = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+        not_modified = if_modified_since is not None and int(last_modified) <= if_modified_since
+    else:
+        not_modified = False
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type=content_type)
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = cache_control
+    return response
@@ -0,0 +1,193 @@
+import logging
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from openid.store.interface import OpenIDStore
+
+from identeco.signals import phase_finished
+from identeco.utils import load_path_attr, setting_changed
+
+
+logger = logging.getLogger(__name__)
+
+
+class PhaseStats(object):
+    # In-process aggregate of the phases timed since the process started.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+
+    def add(self, phase, duration, queries):
+        with self.lock:
+            stats = self.phases.get(phase)
+            if stats is None:
+                stats = self.phases[phase] = {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "queries": 0}
+            stats["count"] += 1
+            stats["seconds"] += duration
+            stats["max_seconds"] = max(stats["max_seconds"], duration)
+            stats["queries"] += queries
+
+    def snapshot(self):
+        with self.lock:
+            return dict((phase, dict(stats)) for phase, stats in self.phases.items())
+
+    def clear(self):
+        with self.lock:
+            self.phases.clear()
+
+
+phase_stats = PhaseStats()
+
+
+class Emitters(object):
+
+    def __init__(self):
+        self.emitters = None
+
+    def get(self):
+        if self.emitters is None:
+            paths = getattr(settings, "IDENTECO_INSTRUMENTATION_EMITTERS", [])
+            self.emitters = [load_path_attr(path) for path in paths]
+        return self.emitters
+
+    def clear(self):
+        self.emitters = None
+
+
+emitters = Emitters()
+
+
+def log_emitter(phase, duration, queries):
+    logger.info(
+        "identeco phase %s took %.3fms with %d queries", phase, duration * 1000, queries,
+        extra={"phase": phase, "duration": duration, "queries": queries},
+    )
+
+
+class StatsdEmitter(object):
+
+    def __init__(self):
+        self.address = (
+            getattr(settings, "IDENTECO_STATSD_HOST", "localhost"),
+            getattr(settings, "IDENTECO_STATSD_PORT", 8125),
+        )
+        self.prefix = getattr(settings, "IDENTECO_STATSD_PREFIX", "identeco")
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, phase, duration, queries):
+        metrics = "{0}.{1}:{2:.3f}|ms\n{0}.{1}.queries:{3}|c".format(self.prefix, phase, duration * 1000, queries)
+        try:
+            self.socket.sendto(metrics, self.address)
+        except socket.error:
+            pass
+
+
+statsd_emitter = StatsdEmitter()
+
+
+def record(phase, duration, queries):
+    phase_stats.add(phase, duration, queries)
+    phase_finished.send(sender=Phase, phase=phase, duration=duration, queries=queries)
+    for emitter in emitters.get():
+        emitter(phase, duration, queries)
+
+
+def query_count(connection):
+    # Django 1.8+ keeps the log in a bounded deque, connection.queries copies it
+    log = getattr(connection, "queries_log", None)
+    if log is None:
+        log = connection.queries
+    return len(log)
+
+
+class Phase(object):
+    # Counts the queries a phase runs from the query logs of every database
+    # connection, so replicas and shards are counted too. The debug cursor is
+    # only turned on for the phase, and reset_queries() keeps running on
+    # request_started, so the logs do not outlive the request.
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.connections = [
+            (connection, connection.use_debug_cursor, query_count(connection))
+            for connection in connections.all()
+        ]
+        for connection, use_debug_cursor, queries in self.connections:
+            connection.use_debug_cursor = True
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self.start
+        queries = 0
+        for connection, use_debug_cursor, start_queries in self.connections:
+            queries += query_count(connection) - start_queries
+            connection.use_debug_cursor = use_debug_cursor
+        record(self.name, duration, queries)
+
+
+class NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_PHASE = NullPhase()
+
+
+def enabled():
+    return getattr(settings, "IDENTECO_INSTRUMENTATION", False)
+
+
+def phase(name):
+    if not enabled():
+        return NULL_PHASE
+    return Phase(name)
+
+
+class InstrumentedStore(OpenIDStore):
+
+    def __init__(self, store):
+        self.store = store
+
+    def storeAssociation(self, server_url, association):
+        with phase("store.storeAssociation"):
+            return self.store.storeAssociation(server_url, association)
+
+    def getAssociation(self, server_url, handle=None):
+        with phase("store.getAssociation"):
+            return self.store.getAssociation(server_url, handle)
+
+    def removeAssociation(self, server_url, handle):
+        with phase("store.removeAssociation"):
+            return self.store.removeAssociation(server_url, handle)
+
+    def useNonce(self, server_url, timestamp, salt):
+        with phase("store.useNonce"):
+            return self.store.useNonce(server_url, timestamp, salt)
+
+    def cleanupNonces(self):
+        with phase("store.cleanupNonces"):
+            return self.store.cleanupNonces()
+
+    def cleanupAssociations(self):
+        with phase("store.cleanupAssociations"):
+            return self.store.cleanupAssociations()
+
+
+def clear_emitters(sender, setting, **kwargs):
+    if setting == "IDENTECO_INSTRUMENTATION_EMITTERS":
+        emitters.clear()
+
+
+setting_changed.connect(clear_emitters)
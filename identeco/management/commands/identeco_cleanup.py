@@ -0,0 +1,41 @@
+import time
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from identeco.utils import load_path_attr
+
+
+class Command(BaseCommand):
+
+    help = "Purge expired associations and nonces from the OpenID store."
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "--interval",
+            type="int",
+            default=0,
+            help="Keep running and purge every INTERVAL seconds.",
+        ),
+    )
+
+    def get_store(self):
+        store = getattr(settings, "IDENTECO_STORE", "identeco.store.DjangoORMStore")
+        return load_path_attr(store)()
+
+    def purge(self, store):
+        for name, cleanup in [("associations", store.cleanupAssociations), ("nonces", store.cleanupNonces)]:
+            start = time.time()
+            purged = cleanup() or 0
+            elapsed = time.time() - start
+            rate = purged / elapsed if elapsed else 0
+            self.stdout.write("Purged {0} expired {1} in {2:.3f}s ({3:.0f} rows/s)".format(purged, name, elapsed, rate))
+
+    def handle(self, *args, **options):
+        store = self.get_store()
+        self.purge(store)
+        while options["interval"] > 0:
+            time.sleep(options["interval"])
+            self.purge(store)
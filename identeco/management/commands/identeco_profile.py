@@ -0,0 +1,60 @@
+from optparse import make_option
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from identeco.profiling import load_profiles, make_token
+
+
+class Command(BaseCommand):
+
+    help = "Merge the endpoint profiles in IDENTECO_PROFILE_DIR and print the hottest functions per OpenID mode."
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "--dir",
+            default=None,
+            help="Read profiles from DIR instead of IDENTECO_PROFILE_DIR.",
+        ),
+        make_option(
+            "--mode",
+            action="append",
+            dest="modes",
+            default=[],
+            help="Only report this OpenID mode. Can be given more than once.",
+        ),
+        make_option(
+            "--sort",
+            default="cumulative",
+            help="The pstats sort key, e.g. cumulative, tottime or calls.",
+        ),
+        make_option(
+            "--limit",
+            type="int",
+            default=25,
+            help="Functions to print per mode.",
+        ),
+        make_option(
+            "--token",
+            action="store_true",
+            default=False,
+            help="Print a token for the X-Identeco-Profile header instead.",
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options["token"]:
+            self.stdout.write(make_token())
+            return
+        directory = options["dir"] or getattr(settings, "IDENTECO_PROFILE_DIR", None)
+        if directory is None:
+            raise CommandError("Set IDENTECO_PROFILE_DIR or pass --dir.")
+        profiles = load_profiles(directory, options["modes"])
+        if not profiles:
+            self.stdout.write("No profiles found in {0}".format(directory))
+        for mode, stats in sorted(profiles.items()):
+            self.stdout.write("== {0} ==".format(mode))
+            stats.stream = StringIO()
+            stats.strip_dirs().sort_stats(options["sort"]).print_stats(options["limit"])
+            self.stdout.write(stats.stream.getvalue())
@@ -0,0 +1,82 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+
+from identeco.models import Association, Nonce
+from identeco.sharding import shard_key, shard_ring
+from identeco.utils import nowfn
+
+
+class Command(BaseCommand):
+
+    help = "Move associations and nonces to the shard they belong to after IDENTECO_STORE_SHARDS changed."
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "--from",
+            action="append",
+            dest="sources",
+            default=[],
+            help="Also move rows off this database alias, e.g. a removed shard. Can be given more than once.",
+        ),
+        make_option(
+            "--batch-size",
+            type="int",
+            default=1000,
+            help="Rows to move per transaction.",
+        ),
+        make_option(
+            "--dry-run",
+            action="store_true",
+            default=False,
+            help="Only count the rows that would be moved.",
+        ),
+    )
+
+    def copy(self, model, using, objects):
+        for obj in objects:
+            obj.pk = None
+        try:
+            with transaction.atomic(using=using):
+                model.objects.using(using).bulk_create(objects)
+        except IntegrityError:
+            # Some rows were written to the new shard already, copy the
+            # others one by one.
+            for obj in objects:
+                try:
+                    with transaction.atomic(using=using):
+                        model.objects.using(using).bulk_create([obj])
+                except IntegrityError:
+                    pass
+
+    def rebalance(self, model, source, batch_size, dry_run):
+        # Expired rows are left for identeco_cleanup.
+        rows = model.objects.using(source).filter(expires__gt=nowfn()).order_by("pk")
+        moved = 0
+        last_pk = 0
+        while True:
+            batch = list(rows.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                return moved
+            last_pk = batch[-1].pk
+            targets = {}
+            for obj in batch:
+                target = shard_ring.get_shard(shard_key(obj))
+                if target != source:
+                    targets.setdefault(target, []).append(obj)
+            for target, objects in targets.iteritems():
+                pks = [obj.pk for obj in objects]
+                if not dry_run:
+                    self.copy(model, target, objects)
+                    model.objects.using(source).filter(pk__in=pks).delete()
+                moved += len(pks)
+
+    def handle(self, *args, **options):
+        sources = shard_ring.get_aliases()
+        sources.extend(alias for alias in options["sources"] if alias not in sources)
+        for source in sources:
+            for name, model in [("associations", Association), ("nonces", Nonce)]:
+                moved = self.rebalance(model, source, options["batch_size"], options["dry_run"])
+                verb = "Would move" if options["dry_run"] else "Moved"
+                self.stdout.write("{0} {1} {2} off {3}".format(verb, moved, name, source))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Association',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('type', models.CharField(max_length=64)),
+                ('server_url', models.CharField(max_length=2047)),
+                ('handle', models.CharField(max_length=255)),
+                ('secret', models.TextField()),
+                ('lifetime', models.PositiveIntegerField()),
+                ('issued', models.DateTimeField()),
+                ('expires', models.DateTimeField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Nonce',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('server_url', models.CharField(max_length=2047)),
+                ('salt', models.CharField(max_length=40)),
+                ('issued', models.DateTimeField()),
+                ('expires', models.DateTimeField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Trust',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('trust_root', models.CharField(max_length=2047)),
+                ('always_trust', models.BooleanField(default=False)),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='trust',
+            unique_together=set([('user', 'trust_root')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='nonce',
+            unique_together=set([('server_url', 'issued', 'salt')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='association',
+            unique_together=set([('server_url', 'handle')]),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import calendar
+
+from django.db import models, migrations
+
+from identeco.models import hash_server_url, nonce_bucket
+
+
+def populate(apps, schema_editor):
+    db = schema_editor.connection.alias
+    Association = apps.get_model("identeco", "Association")
+    Nonce = apps.get_model("identeco", "Nonce")
+    for pk, server_url in Association.objects.using(db).values_list("pk", "server_url").iterator():
+        Association.objects.using(db).filter(pk=pk).update(server_url_hash=hash_server_url(server_url))
+    for pk, server_url, issued in Nonce.objects.using(db).values_list("pk", "server_url", "issued").iterator():
+        Nonce.objects.using(db).filter(pk=pk).update(
+            server_url_hash=hash_server_url(server_url),
+            bucket=nonce_bucket(calendar.timegm(issued.utctimetuple())),
+        )
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("identeco", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="association",
+            name="server_url_hash",
+            field=models.CharField(default="", max_length=40),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="nonce",
+            name="server_url_hash",
+            field=models.CharField(default="", max_length=40),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="nonce",
+            name="bucket",
+            field=models.IntegerField(default=0, db_index=True),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate, noop),
+        migrations.AlterField(
+            model_name="association",
+            name="expires",
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name="association",
+            unique_together=set([("server_url_hash", "handle")]),
+        ),
+        migrations.AlterUniqueTogether(
+            name="nonce",
+            unique_together=set([("server_url_hash", "issued", "salt")]),
+        ),
+        migrations.AlterIndexTogether(
+            name="association",
+            index_together=set([("server_url_hash", "issued")]),
+        ),
+    ]
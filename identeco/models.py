@@ -1,29 +1,59 @@
+import hashlib
+
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from openid.store.nonce import SKEW
+
+
+def hash_server_url(server_url):
+    if isinstance(server_url, unicode):
+        server_url = server_url.encode("utf-8")
+    return hashlib.sha1(server_url).hexdigest()
+
+
+def nonce_bucket(timestamp):
+    # Nonces are grouped in buckets of SKEW seconds by their timestamp, once
+    # a bucket is older than SKEW every nonce in it has expired.
+    return int(timestamp // SKEW)
 
 
 class Nonce(models.Model):
 
     server_url = models.CharField(max_length=2047)
+    server_url_hash = models.CharField(max_length=40)
     salt = models.CharField(max_length=40)
     issued = models.DateTimeField()
     expires = models.DateTimeField()
+    bucket = models.IntegerField(db_index=True)
 
     class Meta:
-        unique_together = ("server_url", "issued", "salt")
+        unique_together = ("server_url_hash", "issued", "salt")
+
+    def save(self, *args, **kwargs):
+        self.server_url_hash = hash_server_url(self.server_url)
+        super(Nonce, self).save(*args, **kwargs)
 
 
 class Association(models.Model):
 
     type = models.CharField(max_length=64)
     server_url = models.CharField(max_length=2047)
+    server_url_hash = models.CharField(max_length=40)
     handle = models.CharField(max_length=255)
     secret = models.TextField()
     lifetime = models.PositiveIntegerField()
     issued = models.DateTimeField()
-    expires = models.DateTimeField()
+    expires = models.DateTimeField(db_index=True)
 
     class Meta:
-        unique_together = ("server_url", "handle")
+        unique_together = ("server_url_hash", "handle")
+        index_together = [("server_url_hash", "issued")]
+
+    def save(self, *args, **kwargs):
+        self.server_url_hash = hash_server_url(self.server_url)
+        super(Association, self).save(*args, **kwargs)
 
 
 class Trust(models.Model):
@@ -34,3 +64,9 @@ class Trust(models.Model):
 
     class Meta:
         unique_together = ("user", "trust_root")
+
+
+@receiver([post_save, post_delete], sender=Trust)
+def invalidate_trust_cache(sender, instance, **kwargs):
+    from identeco.trust import trust_resolver
+    trust_resolver.invalidate(instance.user_id)
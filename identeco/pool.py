@@ -0,0 +1,119 @@
+import Queue
+import threading
+
+from django.conf import settings
+
+from openid import cryptutil
+from openid.dh import DiffieHellman
+from openid.message import OPENID_NS
+from openid.server.server import (
+    AssociateRequest,
+    Decoder,
+    DiffieHellmanSHA1ServerSession,
+    DiffieHellmanSHA256ServerSession,
+    Server,
+)
+
+
+class KeyPairPool(object):
+    # Pre-generates Diffie-Hellman keypairs for the default modulus and
+    # generator in a background thread, so associate requests do not pay for
+    # the modular exponentiation on the request thread.
+
+    def __init__(self, size=32, watermark=8):
+        self.size = size
+        self.watermark = watermark
+        self.keypairs = Queue.Queue(maxsize=size)
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.hits = 0
+        self.empty = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.refill, name="identeco-dh-pool")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def refill(self):
+        while True:
+            while not self.keypairs.full():
+                self.keypairs.put(DiffieHellman.fromDefaults())
+            self.wakeup.wait()
+            self.wakeup.clear()
+
+    def get(self):
+        self.start()
+        try:
+            dh = self.keypairs.get_nowait()
+        except Queue.Empty:
+            dh = None
+        with self.lock:
+            if dh is None:
+                self.empty += 1
+            else:
+                self.hits += 1
+        if self.keypairs.qsize() < self.watermark:
+            self.wakeup.set()
+        if dh is None:
+            # The pool ran dry, generate the keypair inline
+            dh = DiffieHellman.fromDefaults()
+        return dh
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": self.size,
+                "watermark": self.watermark,
+                "available": self.keypairs.qsize(),
+                "hits": self.hits,
+                "empty": self.empty,
+            }
+
+
+keypair_pool = KeyPairPool(
+    size=getattr(settings, "IDENTECO_DH_POOL_SIZE", 32),
+    watermark=getattr(settings, "IDENTECO_DH_POOL_WATERMARK", 8),
+)
+
+
+class PooledSessionMixin(object):
+
+    @classmethod
+    def fromMessage(cls, message):
+        dh_modulus = message.getArg(OPENID_NS, "dh_modulus")
+        dh_gen = message.getArg(OPENID_NS, "dh_gen")
+        consumer_pubkey = message.getArg(OPENID_NS, "dh_consumer_public")
+        if dh_modulus or dh_gen or consumer_pubkey is None:
+            # Non default parameters or an invalid request, let python-openid
+            # deal with it.
+            return super(PooledSessionMixin, cls).fromMessage(message)
+        return cls(keypair_pool.get(), cryptutil.base64ToLong(consumer_pubkey))
+
+
+class PooledDiffieHellmanSHA1ServerSession(PooledSessionMixin, DiffieHellmanSHA1ServerSession):
+    pass
+
+
+class PooledDiffieHellmanSHA256ServerSession(PooledSessionMixin, DiffieHellmanSHA256ServerSession):
+    pass
+
+
+class PooledAssociateRequest(AssociateRequest):
+
+    session_classes = dict(AssociateRequest.session_classes, **{
+        "DH-SHA1": PooledDiffieHellmanSHA1ServerSession,
+        "DH-SHA256": PooledDiffieHellmanSHA256ServerSession,
+    })
+
+
+class PooledDecoder(Decoder):
+
+    _handlers = dict(Decoder._handlers, associate=PooledAssociateRequest.fromMessage)
+
+
+class PooledServer(Server):
+
+    decoderClass = PooledDecoder
@@ -0,0 +1,141 @@
+import atexit
+import cProfile
+import glob
+import os
+import pstats
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core import signing
+
+
+TOKEN_HEADER = "HTTP_X_IDENTECO_PROFILE"
+TOKEN_SALT = "identeco.profiling"
+
+
+def make_token():
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign("profile")
+
+
+def valid_token(token):
+    try:
+        signing.TimestampSigner(salt=TOKEN_SALT).unsign(token, max_age=getattr(settings, "IDENTECO_PROFILE_TOKEN_MAX_AGE", 3600))
+    except signing.BadSignature:
+        return False
+    return True
+
+
+class RequestProfiler(object):
+    # Profiles a sample of requests with cProfile and aggregates the profiles
+    # in-process per OpenID mode. The profiles of a mode are written to one
+    # file in IDENTECO_PROFILE_DIR once there are IDENTECO_PROFILE_FLUSH_EVERY
+    # of them, or the oldest is IDENTECO_PROFILE_FLUSH_SECONDS old, and when
+    # the process exits. The directory keeps the newest IDENTECO_PROFILE_KEEP
+    # files.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.counts = {}
+        self.started = {}
+
+    def should_profile(self, request):
+        token = request.META.get(TOKEN_HEADER)
+        if token:
+            return valid_token(token)
+        rate = getattr(settings, "IDENTECO_PROFILE_SAMPLE_RATE", 0)
+        return rate > 0 and random.random() < rate
+
+    def get_directory(self):
+        return getattr(settings, "IDENTECO_PROFILE_DIR", None)
+
+    def add(self, mode, profile):
+        # Create the stats outside of the lock, it walks the whole profile.
+        stats = pstats.Stats(profile)
+        now = time.time()
+        flush_every = getattr(settings, "IDENTECO_PROFILE_FLUSH_EVERY", 10)
+        flush_seconds = getattr(settings, "IDENTECO_PROFILE_FLUSH_SECONDS", 60)
+        with self.lock:
+            if mode in self.stats:
+                self.stats[mode].add(stats)
+            else:
+                self.stats[mode] = stats
+                self.started[mode] = now
+            self.counts[mode] = self.counts.get(mode, 0) + 1
+            due = [
+                (due_mode, self.counts.pop(due_mode), self.stats.pop(due_mode), self.started.pop(due_mode))
+                for due_mode in list(self.stats)
+                if self.counts[due_mode] >= flush_every or now - self.started[due_mode] >= flush_seconds
+            ]
+        for due_mode, count, due_stats, started in due:
+            self.write(due_mode, count, due_stats)
+
+    def write(self, mode, count, stats):
+        directory = self.get_directory()
+        if directory is None:
+            return
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        name = "{0}.{1}.{2}.{3}.prof".format(mode, int(time.time() * 1000), os.getpid(), count)
+        stats.dump_stats(os.path.join(directory, name))
+        self.rotate(directory)
+
+    def rotate(self, directory):
+        paths = sorted(glob.glob(os.path.join(directory, "*.prof")), key=os.path.getmtime)
+        for path in paths[:-getattr(settings, "IDENTECO_PROFILE_KEEP", 100)]:
+            try:
+                os.remove(path)
+            except OSError:
+                # Another process rotated it away already
+                pass
+
+    def flush(self):
+        with self.lock:
+            pending = [(mode, self.counts[mode], stats) for mode, stats in self.stats.items()]
+            self.stats = {}
+            self.counts = {}
+            self.started = {}
+        for mode, count, stats in pending:
+            self.write(mode, count, stats)
+
+    def profile(self, request, view, call):
+        if not self.should_profile(request):
+            return call()
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return call()
+        finally:
+            profile.disable()
+            self.add(self.get_mode(view), profile)
+
+    def get_mode(self, view):
+        openid_request = getattr(view, "openid_request", None)
+        if openid_request is None:
+            return "other"
+        return openid_request.mode
+
+
+request_profiler = RequestProfiler()
+atexit.register(request_profiler.flush)
+
+
+def load_profiles(directory, modes=None):
+    # Merges the profile files in directory per mode. File names start with
+    # the mode, see RequestProfiler.write.
+    merged = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.prof"))):
+        mode = os.path.basename(path).split(".", 1)[0]
+        if modes and mode not in modes:
+            continue
+        try:
+            if mode in merged:
+                merged[mode].add(path)
+            else:
+                merged[mode] = pstats.Stats(path)
+        except (EOFError, IOError, ValueError):
+            # Rotated away or still being written
+            continue
+    return merged
@@ -0,0 +1,155 @@
+import collections
+import threading
+import time
+import urlparse
+
+from django.conf import settings
+
+from openid.message import OPENID_NS
+
+from identeco.utils import get_cache, setting_changed
+
+
+class TokenBuckets(object):
+    # Token buckets kept in process, in a bounded LRU map. Each bucket is a
+    # (tokens, updated) pair refilled at `rate` tokens per second up to
+    # `burst` tokens.
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.buckets = collections.OrderedDict()
+
+    def take(self, key, rate, burst, cost):
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_size:
+                self.buckets.popitem(last=False)
+            return allowed
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class CacheTokenBuckets(object):
+    # Token buckets shared between processes through a Django cache. The
+    # read-modify-write is not atomic, so concurrent requests may slightly
+    # overshoot the budget.
+
+    key_prefix = "identeco:ratelimit"
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def take(self, key, rate, burst, cost):
+        now = time.time()
+        cache_key = "{0}:{1}:{2}".format(self.key_prefix, key[0], key[1])
+        tokens, updated = self.cache.get(cache_key) or (burst, now)
+        tokens = min(burst, tokens + (now - updated) * rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        self.cache.set(cache_key, (tokens, now), int(burst / rate) + 1 if rate else None)
+        return allowed
+
+    def clear(self):
+        pass
+
+
+class RateLimiter(object):
+    # Admission control per relying party and OpenID mode. Checkid requests
+    # are keyed by the host of their return_to (or trust_root), direct
+    # requests carry no RP identity and are keyed by the client address,
+    # optionally taken from a forwarded header set by trusted proxies.
+    # Every mode has its own budget, so a flood of associate requests cannot
+    # starve the interactive checkid requests of the same RP, and
+    # Diffie-Hellman associate requests cost more than plain ones. Requests
+    # are admitted from their undecoded message, before decoding generates
+    # the Diffie-Hellman keypair of an associate request.
+
+    def __init__(self):
+        self.buckets = None
+        self.lock = threading.Lock()
+        self.allowed = collections.defaultdict(int)
+        self.rejected = collections.defaultdict(int)
+
+    def get_limits(self):
+        return getattr(settings, "IDENTECO_RATE_LIMITS", {})
+
+    def get_buckets(self):
+        if self.buckets is None:
+            alias = getattr(settings, "IDENTECO_RATE_LIMIT_CACHE_ALIAS", None)
+            if alias is not None:
+                self.buckets = CacheTokenBuckets(get_cache(alias))
+            else:
+                self.buckets = TokenBuckets()
+        return self.buckets
+
+    def get_key(self, request, message):
+        if message.getArg(OPENID_NS, "mode") in ["checkid_immediate", "checkid_setup"]:
+            trust_root = message.getArg(OPENID_NS, "trust_root" if message.isOpenID1() else "realm")
+            url = message.getArg(OPENID_NS, "return_to") or trust_root
+            if url:
+                return urlparse.urlparse(url).hostname
+        return self.get_client_address(request)
+
+    def get_client_address(self, request):
+        # Behind reverse proxies REMOTE_ADDR is the proxy. The proxies append
+        # to the forwarded header, so the client is the address the outermost
+        # trusted proxy added, counting from the right.
+        header = getattr(settings, "IDENTECO_RATE_LIMIT_CLIENT_HEADER", None)
+        if header is not None:
+            addresses = [address.strip() for address in request.META.get(header, "").split(",") if address.strip()]
+            proxies = getattr(settings, "IDENTECO_RATE_LIMIT_TRUSTED_PROXIES", 1)
+            if len(addresses) >= proxies:
+                return addresses[-proxies]
+        return request.META.get("REMOTE_ADDR")
+
+    def get_cost(self, message):
+        session_type = message.getArg(OPENID_NS, "session_type")
+        if message.getArg(OPENID_NS, "mode") == "associate" and session_type not in (None, "", "no-encryption"):
+            return getattr(settings, "IDENTECO_RATE_LIMIT_DH_COST", 4)
+        return 1
+
+    def allow(self, request, message):
+        mode = message.getArg(OPENID_NS, "mode")
+        limit = self.get_limits().get(mode)
+        if limit is None:
+            return True
+        rate, burst = limit
+        key = (mode, self.get_key(request, message))
+        allowed = self.get_buckets().take(key, rate, burst, self.get_cost(message))
+        with self.lock:
+            if allowed:
+                self.allowed[mode] += 1
+            else:
+                self.rejected[mode] += 1
+        return allowed
+
+    def stats(self):
+        with self.lock:
+            return {
+                "allowed": dict(self.allowed),
+                "rejected": dict(self.rejected),
+            }
+
+    def clear(self):
+        self.buckets = None
+
+
+rate_limiter = RateLimiter()
+
+
+def clear_rate_limiter(sender, setting, **kwargs):
+    if setting.startswith("IDENTECO_RATE_LIMIT"):
+        rate_limiter.clear()
+
+
+setting_changed.connect(clear_rate_limiter)
@@ -0,0 +1,71 @@
+import collections
+import threading
+
+from django.conf import settings
+
+from identeco import instrumentation
+from identeco.utils import load_path_attr, setting_changed
+
+
+class ServerRegistry(object):
+    # Builds the OpenID store once per process and one IDENTECO_SERVER per
+    # endpoint URL, so per-process state in the store survives across requests.
+    # The endpoint URL comes from the Host header, so the servers are kept in
+    # a bounded LRU map of IDENTECO_SERVER_CACHE_SIZE entries. The
+    # IDENTECO_CLAIMS_PROVIDER is built once per process as well.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.store = None
+        self.servers = collections.OrderedDict()
+        self.claims_provider = None
+
+    def get_store(self):
+        with self.lock:
+            if self.store is None:
+                path = getattr(settings, "IDENTECO_STORE", "identeco.store.DjangoORMStore")
+                self.store = load_path_attr(path)()
+                if instrumentation.enabled():
+                    self.store = instrumentation.InstrumentedStore(self.store)
+            return self.store
+
+    def get_server(self, endpoint):
+        store = self.get_store()
+        with self.lock:
+            server = self.servers.pop(endpoint, None)
+            if server is None:
+                path = getattr(settings, "IDENTECO_SERVER", "openid.server.server.Server")
+                server = load_path_attr(path)(store, endpoint)
+            self.servers[endpoint] = server
+            while len(self.servers) > getattr(settings, "IDENTECO_SERVER_CACHE_SIZE", 100):
+                self.servers.popitem(last=False)
+        return server
+
+    def get_claims_provider(self):
+        with self.lock:
+            if self.claims_provider is None:
+                path = getattr(settings, "IDENTECO_CLAIMS_PROVIDER", "identeco.claims.ClaimsProvider")
+                self.claims_provider = load_path_attr(path)()
+                self.claims_provider.connect()
+            return self.claims_provider
+
+    def clear(self):
+        with self.lock:
+            self.store = None
+            self.servers = collections.OrderedDict()
+            claims_provider, self.claims_provider = self.claims_provider, None
+        if claims_provider is not None:
+            # Keep invalidating claims, with the provider from the new settings.
+            claims_provider.disconnect()
+            self.get_claims_provider()
+
+
+registry = ServerRegistry()
+
+
+def clear_registry(sender, setting, **kwargs):
+    if setting.startswith("IDENTECO_"):
+        registry.clear()
+
+
+setting_changed.connect(clear_registry)
@@ -0,0 +1,94 @@
+import bisect
+import hashlib
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from identeco.models import Association, Nonce
+from identeco.utils import setting_changed
+
+
+def ring_position(value):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return int(hashlib.sha1(value).hexdigest()[:16], 16)
+
+
+def shard_key(obj):
+    # Associations are placed by their handle, nonces by their salt.
+    if isinstance(obj, Association):
+        return obj.handle
+    return obj.salt
+
+
+class ShardRing(object):
+    # A consistent hash ring of database aliases. Every alias owns a number of
+    # points on the ring and a key belongs to the alias owning the first point
+    # after its hash, so adding a shard only moves the keys the new shard
+    # takes over.
+
+    def __init__(self, aliases=None, points=None):
+        self.aliases = aliases
+        self.points = points
+        self.ring = None
+
+    def get_aliases(self):
+        if self.aliases is None:
+            return list(getattr(settings, "IDENTECO_STORE_SHARDS", [DEFAULT_DB_ALIAS]))
+        return list(self.aliases)
+
+    def get_ring(self):
+        if self.ring is None:
+            points = self.points or getattr(settings, "IDENTECO_STORE_SHARD_POINTS", 100)
+            ring = sorted(
+                (ring_position("{0}:{1}".format(alias, i)), alias)
+                for alias in self.get_aliases()
+                for i in xrange(points)
+            )
+            self.ring = ([position for position, alias in ring], [alias for position, alias in ring])
+        return self.ring
+
+    def get_shard(self, key):
+        positions, aliases = self.get_ring()
+        return aliases[bisect.bisect(positions, ring_position(key)) % len(positions)]
+
+    def clear(self):
+        self.ring = None
+
+
+shard_ring = ShardRing()
+
+
+class ShardRouter(object):
+    # Routes Association and Nonce instances to the shard of their handle or
+    # salt and creates their tables on every shard. Add it to DATABASE_ROUTERS
+    # together with IDENTECO_STORE = "identeco.store.ShardedStore".
+
+    models = (Association, Nonce)
+
+    def db_for_model(self, model, instance=None):
+        if model in self.models and instance is not None and shard_key(instance):
+            return shard_ring.get_shard(shard_key(instance))
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self.db_for_model(model, hints.get("instance"))
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_model(model, hints.get("instance"))
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if not isinstance(app_label, basestring):
+            # Django < 1.8 passes the model
+            app_label, model_name = app_label._meta.app_label, app_label._meta.model_name
+        if app_label == "identeco" and model_name in ("association", "nonce") and db in shard_ring.get_aliases():
+            return True
+        return None
+
+
+def clear_shard_ring(sender, setting, **kwargs):
+    if setting.startswith("IDENTECO_STORE_SHARD"):
+        shard_ring.clear()
+
+
+setting_changed.connect(clear_shard_ring)
@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+
+phase_finished = Signal(providing_args=["phase", "duration", "queries"])
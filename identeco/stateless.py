@@ -0,0 +1,170 @@
+import base64
+import hashlib
+import hmac
+import struct
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from openid import cryptutil
+from openid.association import Association, getSecretSize
+from openid.store.interface import OpenIDStore
+from openid.server.server import Server, Signatory
+
+from identeco.utils import load_path_attr
+
+
+HANDLE_PREFIX = "S1."
+
+ASSOCIATION_TYPES = {
+    "HMAC-SHA1": 1,
+    "HMAC-SHA256": 2,
+}
+
+
+def derive_key(key, purpose):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return hmac.new(key, "identeco.stateless." + purpose, hashlib.sha256).digest()
+
+
+def xor(data, keystream):
+    return "".join(chr(ord(a) ^ ord(b)) for a, b in zip(data, keystream))
+
+
+class AssociationCodec(object):
+    # Encodes an association into its own handle. The payload is encrypted
+    # with an HMAC-SHA256 keystream and authenticated, together with the
+    # server_url it was issued for, with a truncated HMAC-SHA256.
+    #
+    # The first key is used to issue new handles; handles issued under any of
+    # the other keys are still accepted, which gives a grace window when
+    # rotating keys.
+
+    nonce_size = 16
+    tag_size = 16
+
+    def __init__(self, keys=None):
+        if keys is None:
+            keys = getattr(settings, "IDENTECO_ASSOCIATION_KEYS", [])
+        if not keys:
+            raise ImproperlyConfigured("IDENTECO_ASSOCIATION_KEYS must contain at least one key")
+        self.keys = [(derive_key(key, "encrypt"), derive_key(key, "mac")) for key in keys]
+
+    def keystream(self, encrypt_key, nonce, length):
+        blocks = []
+        for counter in xrange((length + 31) // 32):
+            blocks.append(hmac.new(encrypt_key, nonce + struct.pack("!I", counter), hashlib.sha256).digest())
+        return "".join(blocks)[:length]
+
+    def sign(self, mac_key, server_url, data):
+        if isinstance(server_url, unicode):
+            server_url = server_url.encode("utf-8")
+        return hmac.new(mac_key, server_url + "\0" + data, hashlib.sha256).digest()[:self.tag_size]
+
+    def encode(self, server_url, secret, issued, lifetime, assoc_type):
+        encrypt_key, mac_key = self.keys[0]
+        payload = struct.pack("!BII", ASSOCIATION_TYPES[assoc_type], issued, lifetime) + secret
+        nonce = cryptutil.getBytes(self.nonce_size)
+        data = nonce + xor(payload, self.keystream(encrypt_key, nonce, len(payload)))
+        data += self.sign(mac_key, server_url, data)
+        return HANDLE_PREFIX + base64.urlsafe_b64encode(data).rstrip("=")
+
+    def decode(self, server_url, handle):
+        if not handle.startswith(HANDLE_PREFIX):
+            return None
+        encoded = str(handle[len(HANDLE_PREFIX):])
+        try:
+            data = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+        except (TypeError, ValueError):
+            return None
+        if len(data) <= self.nonce_size + self.tag_size + struct.calcsize("!BII"):
+            return None
+        data, tag = data[:-self.tag_size], data[-self.tag_size:]
+        for encrypt_key, mac_key in self.keys:
+            if hmac.compare_digest(self.sign(mac_key, server_url, data), tag):
+                break
+        else:
+            return None
+        nonce, ciphertext = data[:self.nonce_size], data[self.nonce_size:]
+        payload = xor(ciphertext, self.keystream(encrypt_key, nonce, len(ciphertext)))
+        size = struct.calcsize("!BII")
+        type_code, issued, lifetime = struct.unpack("!BII", payload[:size])
+        for assoc_type, code in ASSOCIATION_TYPES.items():
+            if code == type_code:
+                return Association(handle, payload[size:], issued, lifetime, assoc_type)
+        return None
+
+
+class StatelessSignatory(Signatory):
+
+    def __init__(self, store):
+        super(StatelessSignatory, self).__init__(store)
+        self.codec = AssociationCodec()
+
+    def createAssociation(self, dumb=True, assoc_type="HMAC-SHA1"):
+        if dumb:
+            # check_authentication removes a dumb association once it has
+            # verified an assertion, which is what stops the assertion from
+            # being verified twice. That needs storage, so only shared
+            # associations are stateless.
+            return super(StatelessSignatory, self).createAssociation(dumb, assoc_type)
+        secret = cryptutil.getBytes(getSecretSize(assoc_type))
+        issued = int(time.time())
+        handle = self.codec.encode(self._normal_key, secret, issued, self.SECRET_LIFETIME, assoc_type)
+        assoc = Association(handle, secret, issued, self.SECRET_LIFETIME, assoc_type)
+        self.store.storeAssociation(self._normal_key, assoc)
+        return assoc
+
+
+class StatelessServer(Server):
+
+    signatoryClass = StatelessSignatory
+
+
+class StatelessStore(OpenIDStore):
+    # Shared associations issued by StatelessSignatory are decoded from their
+    # handle and never touch storage. Anything else, including dumb mode
+    # associations, nonces and handles issued before switching to this store,
+    # goes to the wrapped store.
+
+    def __init__(self, store=None, codec=None):
+        if store is None:
+            path = getattr(settings, "IDENTECO_STATELESS_STORE_BACKEND", "identeco.store.DjangoORMStore")
+            store = load_path_attr(path)()
+        if codec is None:
+            codec = AssociationCodec()
+        self.store = store
+        self.codec = codec
+
+    def storeAssociation(self, server_url, association):
+        if not association.handle.startswith(HANDLE_PREFIX):
+            self.store.storeAssociation(server_url, association)
+
+    def getAssociation(self, server_url, handle=None):
+        if handle is None or not handle.startswith(HANDLE_PREFIX):
+            return self.store.getAssociation(server_url, handle)
+        if server_url == Signatory._dumb_key:
+            # Could not be removed after check_authentication, see
+            # StatelessSignatory.createAssociation
+            return None
+        association = self.codec.decode(server_url, handle)
+        if association is None or association.expiresIn <= 0:
+            return None
+        return association
+
+    def removeAssociation(self, server_url, handle):
+        if handle.startswith(HANDLE_PREFIX):
+            # Stateless handles cannot be revoked, they expire on their own
+            return False
+        return self.store.removeAssociation(server_url, handle)
+
+    def useNonce(self, server_url, timestamp, salt):
+        return self.store.useNonce(server_url, timestamp, salt)
+
+    def cleanupNonces(self):
+        return self.store.cleanupNonces()
+
+    def cleanupAssociations(self):
+        return self.store.cleanupAssociations()
@@ -1,94 +1,781 @@
 import base64
+import calendar
+import collections
+import contextlib
 import datetime
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
 import time
 
+from multiprocessing.pool import ThreadPool
+
 import pytz
 
 from openid.association import Association as OpenIDAssociation
+from openid.server.server import Signatory
 from openid.store.interface import OpenIDStore
 from openid.store.nonce import SKEW
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connections, router, transaction
+
+from identeco.models import Association, Nonce, hash_server_url, nonce_bucket
+from identeco.sharding import shard_ring
+from identeco.utils import get_cache, load_path_attr, nowfn
+
+
+logger = logging.getLogger(__name__)
+
 
-from identeco.models import Association, Nonce
-from identeco.utils import nowfn
+def timestamp_to_datetime(timestamp):
+    # Construct a datetime from a timestamp that Django can store
+    value = datetime.datetime.utcfromtimestamp(timestamp).replace(tzinfo=pytz.utc)
+    if not getattr(settings, "USE_TZ", False):
+        # Django isn't storing timezones, we should normalize to settings.TIME_ZONE
+        value = value.astimezone(pytz.timezone(settings.TIME_ZONE)).replace(tzinfo=None)
+    return value
+
+
+def datetime_to_timestamp(value):
+    # Construct a UTC timestamp from a datetime
+    if value.tzinfo is None:
+        # Assume TZ is settings.TIME_ZONE
+        value = pytz.timezone(settings.TIME_ZONE).localize(value)
+    return calendar.timegm(value.utctimetuple())
+
+
+def delete_in_batches(queryset, batch_size=None):
+    # Delete by primary key in bounded batches so a large purge never holds
+    # long locks on the table.
+    if batch_size is None:
+        batch_size = getattr(settings, "IDENTECO_CLEANUP_BATCH_SIZE", 1000)
+    deleted = 0
+    while True:
+        pks = list(queryset.order_by("pk").values_list("pk", flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        queryset.model._default_manager.using(queryset.db).filter(pk__in=pks).delete()
+        deleted += len(pks)
 
 
 class DjangoORMStore(OpenIDStore):
+    # db_for_read / db_for_write choose the database for a row. key is the
+    # association handle or the nonce salt when there is one.
+
+    def db_for_read(self, model, server_url=None, key=None):
+        return router.db_for_read(model)
+
+    def db_for_write(self, model, server_url=None, key=None):
+        return router.db_for_write(model)
 
     def storeAssociation(self, server_url, association):
-        defaults = {
+        issued = timestamp_to_datetime(association.issued)
+        values = {
             "type": association.assoc_type,
             "secret": base64.b64encode(association.secret),
             "lifetime": association.lifetime,
+            "issued": issued,
+            "expires": issued + datetime.timedelta(seconds=association.lifetime),
         }
-        # Construct a datetime from a timestamp that Django can store
-        issued = datetime.datetime.utcfromtimestamp(association.issued)
-        issued.replace(tzinfo=pytz.utc)
-        if not getattr(settings, "USE_TZ", False):
-            # Django isn't storing timezones, we should normalize to settings.TIME_ZONE
-            issued = issued.astimezone(pytz.timezone(settings.TIME_ZONE))
-            issued.replace(tzinfo=None)
-        defaults["issued"] = issued
-        defaults["expires"] = issued + datetime.timedelta(seconds=defaults["lifetime"])
-        a, created = Association.objects.get_or_create(
-            server_url=server_url,
-            handle=association.handle,
-            defaults=defaults,
+        connection = connections[self.db_for_write(Association, server_url, association.handle)]
+        with transaction.atomic(using=connection.alias):
+            if not self.upsert_association(connection, server_url, association.handle, values):
+                self.update_or_create_association(connection, server_url, association.handle, values)
+
+    def upsert_association(self, connection, server_url, handle, values):
+        # Store the association with a single native upsert statement where
+        # the backend supports one. Returns False if it does not.
+        if connection.vendor == "postgresql" and getattr(connection, "pg_version", 0) >= 90500:
+            template = "INSERT INTO {table} ({columns}) VALUES ({params}) ON CONFLICT ({server_url_hash}, {handle}) DO UPDATE SET {updates}"
+            update_template = "{0} = EXCLUDED.{0}"
+        elif connection.vendor == "mysql":
+            template = "INSERT INTO {table} ({columns}) VALUES ({params}) ON DUPLICATE KEY UPDATE {updates}"
+            update_template = "{0} = VALUES({0})"
+        elif connection.vendor == "sqlite":
+            template = "INSERT OR REPLACE INTO {table} ({columns}) VALUES ({params})"
+            update_template = "{0}"
+        else:
+            return False
+        qn = connection.ops.quote_name
+        values = dict(values, server_url=server_url, server_url_hash=hash_server_url(server_url), handle=handle)
+        fields = [Association._meta.get_field(name) for name in sorted(values)]
+        sql = template.format(
+            table=qn(Association._meta.db_table),
+            columns=", ".join(qn(f.column) for f in fields),
+            params=", ".join(["%s"] * len(fields)),
+            server_url_hash=qn(Association._meta.get_field("server_url_hash").column),
+            handle=qn(Association._meta.get_field("handle").column),
+            updates=", ".join(update_template.format(qn(f.column)) for f in fields if f.name not in ("server_url", "server_url_hash", "handle")),
         )
-        if not created:
-            Association.objects.filter(pk=a.pk).update(**defaults)
+        params = [f.get_db_prep_save(values[f.name], connection=connection) for f in fields]
+        connection.cursor().execute(sql, params)
+        return True
+
+    def update_or_create_association(self, connection, server_url, handle, values):
+        assocs = Association.objects.using(connection.alias).filter(server_url_hash=hash_server_url(server_url), handle=handle)
+        if assocs.update(**values):
+            return
+        try:
+            with transaction.atomic(using=connection.alias):
+                Association.objects.using(connection.alias).create(server_url=server_url, handle=handle, **values)
+        except IntegrityError:
+            # A concurrent request stored the same handle first
+            assocs.update(**values)
 
     def getAssociation(self, server_url, handle=None):
-        self.cleanupAssociations()
-        assocs = Association.objects.filter(server_url=server_url)
+        return self.get_association_from(self.db_for_read(Association, server_url, handle), server_url, handle)
+
+    def get_association_from(self, using, server_url, handle=None):
+        # Expired rows are purged out of band by the identeco_cleanup command
+        assocs = Association.objects.using(using).filter(
+            server_url_hash=hash_server_url(server_url),
+            server_url=server_url,
+            expires__gt=nowfn(),
+        )
         if handle is not None:
             assocs = assocs.filter(handle=handle)
         else:
             assocs = assocs.order_by("-issued")
-        if assocs:
-            a = assocs[0]
-            # Construct a UTC timestamp from a datetime
-            issued = a.issued
-            if issued.tzinfo is None:
-                # Assume TZ is settings.TIME_ZONE
-                issued.replace(tzinfo=pytz.timezone(settings.TIME_ZONE))
-            if issued.tzinfo != pytz.utc:
-                # Normalize to UTC
-                issued = issued.astimezone(pytz.utc)
-            issued = int(time.mktime(issued.utctimetuple()))
+        for a in assocs[:1]:
+            issued = datetime_to_timestamp(a.issued)
             return OpenIDAssociation(a.handle, base64.b64decode(a.secret), issued, a.lifetime, a.type)
 
     def removeAssociation(self, server_url, handle):
+        assocs = Association.objects.using(self.db_for_write(Association, server_url, handle))
         try:
-            assoc = Association.objects.get(server_url=server_url, handle=handle)
+            assoc = assocs.get(server_url_hash=hash_server_url(server_url), server_url=server_url, handle=handle)
             assoc.delete()
             return True
         except Association.DoesNotExist:
             return False
 
     def useNonce(self, server_url, timestamp, salt):
-        issued = datetime.datetime.utcfromtimestamp(timestamp)
-        issued.replace(tzinfo=pytz.utc)
-        if not getattr(settings, "USE_TZ", False):
-            # Django isn't storing timezones, we should normalize to settings.TIME_ZONE
-            issued = issued.astimezone(pytz.timezone(settings.TIME_ZONE))
-            issued.replace(tzinfo=None)
-        if issued - nowfn() > datetime.timedelta(seconds=SKEW):
+        issued = timestamp_to_datetime(timestamp)
+        if abs(issued - nowfn()) > datetime.timedelta(seconds=SKEW):
             # Skew on timestamp is too large
             return False
-        _, created = Nonce.objects.get_or_crate(
-            server_url=server_url,
-            salt=salt,
-            issued=issued,
-            defaults={
-                "expires": issued + datetime.timedelta(seconds=SKEW)
+        # Insert unconditionally, the unique constraint tells us whether the
+        # nonce has been used before.
+        using = self.db_for_write(Nonce, server_url, salt)
+        try:
+            with transaction.atomic(using=using):
+                Nonce.objects.using(using).create(
+                    server_url=server_url,
+                    salt=salt,
+                    issued=issued,
+                    expires=issued + datetime.timedelta(seconds=SKEW),
+                    bucket=nonce_bucket(timestamp),
+                )
+        except IntegrityError:
+            return False
+        return True
+
+    def cleanupNonces(self):
+        return self.cleanup_nonces_from(self.db_for_write(Nonce))
+
+    def cleanup_nonces_from(self, using):
+        # Select whole buckets, every nonce in a bucket older than the previous
+        # one has expired.
+        nonces = Nonce.objects.using(using)
+        return delete_in_batches(nonces.filter(bucket__lt=nonce_bucket(time.time()) - 1))
+
+    def cleanupAssociations(self):
+        return self.cleanup_associations_from(self.db_for_write(Association))
+
+    def cleanup_associations_from(self, using):
+        return delete_in_batches(Association.objects.using(using).filter(expires__lte=nowfn()))
+
+
+class ReplicaStore(DjangoORMStore):
+    # Reads associations from a replica and falls back to the primary when
+    # the replica does not have them (yet), which covers a handle read right
+    # after it was stored. Dumb mode associations are always read from the
+    # primary: check_authentication removes them once they are used, and a
+    # lagging replica would let the same assertion be checked again.
+
+    def __init__(self, replica=None, primary=None):
+        if replica is None:
+            replica = getattr(settings, "IDENTECO_STORE_REPLICA", None)
+        if primary is None:
+            primary = getattr(settings, "IDENTECO_STORE_PRIMARY", None)
+        self.replica = replica
+        self.primary = primary
+        self.lock = threading.Lock()
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.fallbacks = 0
+
+    def db_for_read(self, model, server_url=None, key=None):
+        if self.replica is None:
+            return self.db_for_write(model, server_url, key)
+        return self.replica
+
+    def db_for_write(self, model, server_url=None, key=None):
+        if self.primary is None:
+            return super(ReplicaStore, self).db_for_write(model, server_url, key)
+        return self.primary
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def getAssociation(self, server_url, handle=None):
+        primary = self.db_for_write(Association, server_url, handle)
+        replica = self.db_for_read(Association, server_url, handle)
+        if replica == primary or server_url == Signatory._dumb_key:
+            self.count("primary_reads")
+            return self.get_association_from(primary, server_url, handle)
+        self.count("replica_reads")
+        association = self.get_association_from(replica, server_url, handle)
+        if association is None:
+            self.count("fallbacks")
+            association = self.get_association_from(primary, server_url, handle)
+        return association
+
+    def stats(self):
+        with self.lock:
+            return {
+                "replica_reads": self.replica_reads,
+                "primary_reads": self.primary_reads,
+                "fallbacks": self.fallbacks,
             }
+
+
+class ShardedStore(DjangoORMStore):
+    # Spreads associations and nonces over IDENTECO_STORE_SHARDS by a
+    # consistent hash of the association handle or the nonce salt. The OpenID
+    # server only ever uses two server_urls, so the server_url cannot spread
+    # the rows. Every lookup the server makes names a handle, only lookups of
+    # the latest association of a server_url ask every shard. Cleanup runs on
+    # every shard in parallel.
+
+    def __init__(self, ring=None):
+        if ring is None:
+            ring = shard_ring
+        self.ring = ring
+
+    def db_for_read(self, model, server_url=None, key=None):
+        return self.db_for_write(model, server_url, key)
+
+    def db_for_write(self, model, server_url=None, key=None):
+        if key is None:
+            return super(ShardedStore, self).db_for_write(model, server_url, key)
+        return self.ring.get_shard(key)
+
+    def getAssociation(self, server_url, handle=None):
+        if handle is not None:
+            return super(ShardedStore, self).getAssociation(server_url, handle)
+        associations = [self.get_association_from(using, server_url) for using in self.ring.get_aliases()]
+        associations = [association for association in associations if association is not None]
+        if not associations:
+            return None
+        return max(associations, key=lambda association: association.issued)
+
+    def on_each_shard(self, cleanup):
+        def run(using):
+            try:
+                return cleanup(using)
+            finally:
+                # Connections are per thread, don't leave this one open.
+                connections[using].close()
+        aliases = self.ring.get_aliases()
+        if len(aliases) == 1:
+            return cleanup(aliases[0])
+        pool = ThreadPool(len(aliases))
+        try:
+            return sum(pool.map(run, aliases))
+        finally:
+            pool.close()
+
+    def cleanupNonces(self):
+        return self.on_each_shard(self.cleanup_nonces_from)
+
+    def cleanupAssociations(self):
+        return self.on_each_shard(self.cleanup_associations_from)
+
+
+class AssociationCache(object):
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, server_url, handle):
+        key = (server_url, handle)
+        with self.lock:
+            association = self.entries.pop(key, None)
+            if association is None or association.expiresIn <= 0:
+                self.misses += 1
+                return None
+            # Re-insert to mark the entry as most recently used
+            self.entries[key] = association
+            self.hits += 1
+            return association
+
+    def set(self, server_url, handle, association):
+        key = (server_url, handle)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = association
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, server_url, handle=None):
+        with self.lock:
+            self.entries.pop((server_url, handle), None)
+            if handle is not None:
+                # The latest association for server_url may be this one
+                self.entries.pop((server_url, None), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+association_cache = AssociationCache(
+    max_size=getattr(settings, "IDENTECO_ASSOCIATION_CACHE_SIZE", 1000),
+)
+
+
+class CachedStore(OpenIDStore):
+    # Dumb mode associations are never cached. check_authentication removes
+    # them to stop a replay, and that removal may happen in another process.
+
+    def __init__(self, store=None, cache=None):
+        if store is None:
+            path = getattr(settings, "IDENTECO_CACHED_STORE_BACKEND", "identeco.store.DjangoORMStore")
+            store = load_path_attr(path)()
+        if cache is None:
+            cache = association_cache
+        self.store = store
+        self.cache = cache
+
+    def storeAssociation(self, server_url, association):
+        self.store.storeAssociation(server_url, association)
+        self.cache.invalidate(server_url, association.handle)
+        if server_url != Signatory._dumb_key:
+            self.cache.set(server_url, association.handle, association)
+
+    def getAssociation(self, server_url, handle=None):
+        if server_url == Signatory._dumb_key:
+            return self.store.getAssociation(server_url, handle)
+        association = self.cache.get(server_url, handle)
+        if association is None:
+            association = self.store.getAssociation(server_url, handle)
+            if association is not None:
+                self.cache.set(server_url, handle, association)
+        return association
+
+    def removeAssociation(self, server_url, handle):
+        self.cache.invalidate(server_url, handle)
+        return self.store.removeAssociation(server_url, handle)
+
+    def useNonce(self, server_url, timestamp, salt):
+        return self.store.useNonce(server_url, timestamp, salt)
+
+    def cleanupNonces(self):
+        return self.store.cleanupNonces()
+
+    def cleanupAssociations(self):
+        return self.store.cleanupAssociations()
+
+
+class CacheStore(OpenIDStore):
+
+    key_prefix = "identeco"
+
+    def __init__(self, cache=None):
+        if cache is None:
+            cache = get_cache(getattr(settings, "IDENTECO_CACHE_STORE_ALIAS", "default"))
+        self.cache = cache
+
+    def make_key(self, kind, *parts):
+        parts = [part.encode("utf-8") if isinstance(part, unicode) else part for part in parts]
+        digest = hashlib.sha1("\0".join(parts)).hexdigest()
+        return "{0}:{1}:{2}".format(self.key_prefix, kind, digest)
+
+    def association_key(self, server_url, handle=None):
+        if handle is None:
+            return self.make_key("latest", server_url)
+        return self.make_key("assoc", server_url, handle)
+
+    def storeAssociation(self, server_url, association):
+        timeout = association.expiresIn
+        if timeout <= 0:
+            return
+        value = association.serialize()
+        self.cache.set(self.association_key(server_url, association.handle), value, timeout)
+        latest = self.getAssociation(server_url)
+        if latest is None or latest.issued <= association.issued:
+            self.cache.set(self.association_key(server_url), value, timeout)
+
+    def getAssociation(self, server_url, handle=None):
+        value = self.cache.get(self.association_key(server_url, handle))
+        if value is None:
+            return None
+        association = OpenIDAssociation.deserialize(value)
+        if association.expiresIn <= 0:
+            return None
+        return association
+
+    def removeAssociation(self, server_url, handle):
+        key = self.association_key(server_url, handle)
+        if self.cache.get(key) is None:
+            return False
+        self.cache.delete(key)
+        latest = self.getAssociation(server_url)
+        if latest is not None and latest.handle == handle:
+            self.cache.delete(self.association_key(server_url))
+        return True
+
+    def useNonce(self, server_url, timestamp, salt):
+        if abs(timestamp - time.time()) > SKEW:
+            return False
+        key = self.make_key("nonce", server_url, str(timestamp), salt)
+        # add() is atomic, it only succeeds for a nonce we have not seen yet
+        return self.cache.add(key, 1, SKEW)
+
+    def cleanupNonces(self):
+        # Entries expire natively in the cache backend
+        return 0
+
+    def cleanupAssociations(self):
+        return 0
+
+
+class NonceFilter(object):
+
+    def __init__(self, window=SKEW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def digest(self, server_url, timestamp, salt):
+        if isinstance(server_url, unicode):
+            server_url = server_url.encode("utf-8")
+        if isinstance(salt, unicode):
+            salt = salt.encode("utf-8")
+        # 64 bits of the digest keep entries small, a false positive needs a
+        # collision between two live nonces.
+        return int(hashlib.sha1("{0}\0{1}\0{2}".format(server_url, timestamp, salt)).hexdigest()[:16], 16)
+
+    def rotate(self, now):
+        current = int(now // self.window)
+        for bucket in list(self.buckets):
+            if bucket < current - 1:
+                del self.buckets[bucket]
+
+    def seen(self, server_url, timestamp, salt):
+        bucket = int(timestamp // self.window)
+        with self.lock:
+            return self.digest(server_url, timestamp, salt) in self.buckets.get(bucket, ())
+
+    def add(self, server_url, timestamp, salt):
+        bucket = int(timestamp // self.window)
+        with self.lock:
+            self.rotate(time.time())
+            self.buckets.setdefault(bucket, set()).add(self.digest(server_url, timestamp, salt))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "buckets": len(self.buckets),
+                "nonces": sum(len(nonces) for nonces in self.buckets.values()),
+            }
+
+
+nonce_filter = NonceFilter()
+
+
+class NonceFilterStore(OpenIDStore):
+    # Rejects out of window and replayed nonces in memory, using the nonces
+    # this process has already seen. Everything else falls through to the
+    # wrapped store, which stays the authority across processes.
+
+    def __init__(self, store=None, nonces=None):
+        if store is None:
+            path = getattr(settings, "IDENTECO_NONCE_FILTER_STORE_BACKEND", "identeco.store.DjangoORMStore")
+            store = load_path_attr(path)()
+        if nonces is None:
+            nonces = nonce_filter
+        self.store = store
+        self.nonces = nonces
+        self.rejected = 0
+        self.passed = 0
+
+    def storeAssociation(self, server_url, association):
+        return self.store.storeAssociation(server_url, association)
+
+    def getAssociation(self, server_url, handle=None):
+        return self.store.getAssociation(server_url, handle)
+
+    def removeAssociation(self, server_url, handle):
+        return self.store.removeAssociation(server_url, handle)
+
+    def useNonce(self, server_url, timestamp, salt):
+        if abs(timestamp - time.time()) > SKEW or self.nonces.seen(server_url, timestamp, salt):
+            self.rejected += 1
+            return False
+        self.passed += 1
+        used = self.store.useNonce(server_url, timestamp, salt)
+        # Remember the nonce either way, a replay of it must be rejected
+        self.nonces.add(server_url, timestamp, salt)
+        return used
+
+    def cleanupNonces(self):
+        return self.store.cleanupNonces()
+
+    def cleanupAssociations(self):
+        return self.store.cleanupAssociations()
+
+
+class MmapStore(OpenIDStore):
+    # Keeps associations and nonces in open addressing hash tables in a fixed
+    # size memory mapped file, shared by every process on the host. Records
+    # have a fixed width and an expiry, and expired slots are reused as they
+    # are found. A key only ever lives within PROBES slots of its hash, so a
+    # lookup reads a bounded window and the file never grows. A full window
+    # evicts the association that expires first and refuses the nonce.
+    #
+    # The file starts with a header, followed by the nonce table, the
+    # association table and a table of the latest association per server_url.
+    # Processes serialize on flock(), threads on a lock.
+
+    MAGIC = "IDENTECO-MMAP-1\0"
+    PROBES = 32
+    header = struct.Struct("<16sII")
+    # digest, expires
+    nonce = struct.Struct("<QI")
+    nonce_window = struct.Struct("<" + "QI" * PROBES)
+    # digest, issued, lifetime, assoc_type, handle, secret length, secret
+    association = struct.Struct("<QII16s255sB64s")
+    association_expiry = struct.Struct("<QII")
+    # server_url digest, association digest, issued
+    latest = struct.Struct("<QQI")
+
+    def __init__(self, path=None, associations=None, nonces=None):
+        if path is None:
+            path = getattr(settings, "IDENTECO_MMAP_STORE_PATH", None)
+        if path is None:
+            raise ImproperlyConfigured("MmapStore requires IDENTECO_MMAP_STORE_PATH")
+        if associations is None:
+            associations = getattr(settings, "IDENTECO_MMAP_STORE_ASSOCIATIONS", 131072)
+        if nonces is None:
+            nonces = getattr(settings, "IDENTECO_MMAP_STORE_NONCES", 65536)
+        self.path = path
+        self.association_slots = associations
+        self.nonce_slots = nonces
+        self.nonce_offset = self.header.size
+        self.association_offset = self.nonce_offset + (nonces + self.PROBES) * self.nonce.size
+        self.latest_offset = self.association_offset + (associations + self.PROBES) * self.association.size
+        self.size = self.latest_offset + (associations + self.PROBES) * self.latest.size
+        self.lock = threading.Lock()
+        self.pid = None
+        self.fd = None
+        self.map = None
+        self.full = 0
+        self.evicted = 0
+
+    def open(self):
+        # flock() locks belong to the open file, a forked worker must open
+        # the file again to be excluded from its parent.
+        if self.pid == os.getpid():
+            return
+        if self.map is not None:
+            self.map.close()
+            os.close(self.fd)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            header = self.header.pack(self.MAGIC, self.association_slots, self.nonce_slots)
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, self.size)
+                os.write(fd, header)
+            elif os.read(fd, self.header.size) != header or os.fstat(fd).st_size != self.size:
+                raise ImproperlyConfigured("{0} was created with different IDENTECO_MMAP_STORE_* settings".format(self.path))
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        except Exception:
+            os.close(fd)
+            raise
+        self.fd = fd
+        self.map = mmap.mmap(fd, self.size)
+        self.pid = os.getpid()
+
+    @contextlib.contextmanager
+    def locked(self, operation):
+        with self.lock:
+            self.open()
+            fcntl.flock(self.fd, operation)
+            try:
+                yield self.map
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def digest(self, *parts):
+        parts = [part.encode("utf-8") if isinstance(part, unicode) else str(part) for part in parts]
+        # Zero marks an empty slot
+        return struct.unpack("<Q", hashlib.sha1("\0".join(parts)).digest()[:8])[0] or 1
+
+    def window(self, offset, record, slots, digest):
+        start = offset + (digest % slots) * record.size
+        return xrange(start, start + self.PROBES * record.size, record.size)
+
+    def read_association(self, data, position, now):
+        digest, issued, lifetime, assoc_type, handle, length, secret = self.association.unpack_from(data, position)
+        if issued + lifetime <= now:
+            return None
+        return OpenIDAssociation(handle.rstrip("\0"), secret[:length], issued, lifetime, assoc_type.rstrip("\0"))
+
+    def find_association(self, data, digest, now):
+        for position in self.window(self.association_offset, self.association, self.association_slots, digest):
+            slot, issued, lifetime = self.association_expiry.unpack_from(data, position)
+            if slot == digest and issued + lifetime > now:
+                return position
+        return None
+
+    def storeAssociation(self, server_url, association):
+        if len(association.handle) > 255 or len(association.secret) > 64:
+            raise ValueError("MmapStore cannot store handles over 255 or secrets over 64 bytes")
+        digest = self.digest(server_url, association.handle)
+        url_digest = self.digest(server_url)
+        now = int(time.time())
+        record = self.association.pack(
+            digest,
+            association.issued,
+            association.lifetime,
+            association.assoc_type,
+            association.handle,
+            len(association.secret),
+            association.secret,
         )
-        return created
+        with self.locked(fcntl.LOCK_EX) as data:
+            free = None
+            soonest = None
+            for position in self.window(self.association_offset, self.association, self.association_slots, digest):
+                slot, issued, lifetime = self.association_expiry.unpack_from(data, position)
+                if slot == digest:
+                    free = position
+                    break
+                if free is None and (slot == 0 or issued + lifetime <= now):
+                    free = position
+                if soonest is None or issued + lifetime < soonest[0]:
+                    soonest = (issued + lifetime, position)
+            if free is None:
+                # Every slot of the window holds a live association. Losing
+                # the one that expires first is better than handing out a
+                # handle that cannot be found.
+                self.evicted += 1
+                free = soonest[1]
+                logger.warning("MmapStore evicted a live association, raise IDENTECO_MMAP_STORE_ASSOCIATIONS")
+            data[free:free + self.association.size] = record
+            latest = None
+            for position in self.window(self.latest_offset, self.latest, self.association_slots, url_digest):
+                slot, association_digest, issued = self.latest.unpack_from(data, position)
+                if slot == url_digest:
+                    if issued > association.issued:
+                        return
+                    latest = position
+                    break
+                if latest is None and (slot == 0 or self.find_association(data, association_digest, now) is None):
+                    latest = position
+            if latest is not None:
+                self.latest.pack_into(data, latest, url_digest, digest, association.issued)
+
+    def getAssociation(self, server_url, handle=None):
+        now = int(time.time())
+        with self.locked(fcntl.LOCK_SH) as data:
+            if handle is None:
+                url_digest = self.digest(server_url)
+                for position in self.window(self.latest_offset, self.latest, self.association_slots, url_digest):
+                    slot, digest, issued = self.latest.unpack_from(data, position)
+                    if slot == url_digest:
+                        break
+                else:
+                    return None
+            else:
+                digest = self.digest(server_url, handle)
+            position = self.find_association(data, digest, now)
+            if position is None:
+                return None
+            return self.read_association(data, position, now)
+
+    def removeAssociation(self, server_url, handle):
+        digest = self.digest(server_url, handle)
+        with self.locked(fcntl.LOCK_EX) as data:
+            position = self.find_association(data, digest, int(time.time()))
+            if position is None:
+                return False
+            data[position:position + self.association.size] = "\0" * self.association.size
+            return True
+
+    def useNonce(self, server_url, timestamp, salt):
+        now = int(time.time())
+        if abs(timestamp - now) > SKEW:
+            return False
+        digest = self.digest(server_url, timestamp, salt)
+        start = self.nonce_offset + (digest % self.nonce_slots) * self.nonce.size
+        with self.locked(fcntl.LOCK_EX) as data:
+            free = None
+            window = self.nonce_window.unpack_from(data, start)
+            for i in xrange(0, len(window), 2):
+                slot, expires = window[i], window[i + 1]
+                if slot == digest and expires > now:
+                    return False
+                if free is None and (slot == 0 or expires <= now):
+                    free = start + i // 2 * self.nonce.size
+            if free is None:
+                # Every slot of the window holds a live nonce. Refuse rather
+                # than evict one, which would let it be replayed.
+                self.full += 1
+                return False
+            self.nonce.pack_into(data, free, digest, timestamp + SKEW)
+            return True
 
     def cleanupNonces(self):
-        return Nonce.objects.filter(expires__lte=nowfn()).delete()
+        # Expired slots are reused as they are found, this only zeroes them.
+        now = int(time.time())
+        purged = 0
+        with self.locked(fcntl.LOCK_EX) as data:
+            for position in xrange(self.nonce_offset, self.association_offset, self.nonce.size):
+                slot, expires = self.nonce.unpack_from(data, position)
+                if slot and expires <= now:
+                    self.nonce.pack_into(data, position, 0, 0)
+                    purged += 1
+        return purged
 
     def cleanupAssociations(self):
-        return Association.objects.filter(expires__lte=nowfn()).delete()
+        now = int(time.time())
+        purged = 0
+        with self.locked(fcntl.LOCK_EX) as data:
+            for position in xrange(self.association_offset, self.latest_offset, self.association.size):
+                slot, issued, lifetime = self.association_expiry.unpack_from(data, position)
+                if slot and issued + lifetime <= now:
+                    data[position:position + self.association.size] = "\0" * self.association.size
+                    purged += 1
+        return purged
+
+    def stats(self):
+        return {
+            "full": self.full,
+            "evicted": self.evicted,
+        }
@@ -0,0 +1,86 @@
+from django.conf import settings
+
+from identeco.models import Trust
+from identeco.utils import get_cache, setting_changed
+
+
+class DomainIndex(object):
+    # A trie of reversed hostname labels. "*.corp.example" matches any
+    # hostname below corp.example, but not corp.example itself.
+
+    def __init__(self, domains=()):
+        self.root = {}
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain):
+        node = self.root
+        for label in reversed(domain.lower().rstrip(".").split(".")):
+            node = node.setdefault(label, {})
+        node[None] = True
+
+    def match(self, hostname):
+        if not hostname:
+            return False
+        node = self.root
+        for label in reversed(hostname.lower().rstrip(".").split(".")):
+            if "*" in node:
+                return True
+            node = node.get(label)
+            if node is None:
+                return False
+        return None in node
+
+
+class TrustResolver(object):
+    # Decides whether a user always trusts a trust root. The roots a user
+    # always trusts are cached per user as one set, which answers both trusted
+    # and not trusted without a query, and is invalidated whenever one of the
+    # user's Trust rows is saved or deleted.
+
+    key_prefix = "identeco:trust"
+
+    def __init__(self):
+        self.domains = None
+
+    def get_domains(self):
+        if self.domains is None:
+            self.domains = DomainIndex(getattr(settings, "IDENTECO_TRUSTED_DOMAINS", []))
+        return self.domains
+
+    def get_cache(self):
+        return get_cache(getattr(settings, "IDENTECO_TRUST_CACHE_ALIAS", "default"))
+
+    def make_key(self, user_id):
+        return "{0}:{1}".format(self.key_prefix, user_id)
+
+    def get_trusted_roots(self, user):
+        cache = self.get_cache()
+        key = self.make_key(user.pk)
+        roots = cache.get(key)
+        if roots is None:
+            roots = frozenset(Trust.objects.filter(user=user, always_trust=True).values_list("trust_root", flat=True))
+            cache.set(key, roots, getattr(settings, "IDENTECO_TRUST_CACHE_TIMEOUT", 3600))
+        return roots
+
+    def is_trusted(self, user, trust_root, hostname=None):
+        if hostname is not None and self.get_domains().match(hostname):
+            return True
+        return trust_root in self.get_trusted_roots(user)
+
+    def invalidate(self, user_id):
+        self.get_cache().delete(self.make_key(user_id))
+
+    def clear(self):
+        self.domains = None
+
+
+trust_resolver = TrustResolver()
+
+
+def clear_trust_resolver(sender, setting, **kwargs):
+    if setting == "IDENTECO_TRUSTED_DOMAINS":
+        trust_resolver.clear()
+
+
+setting_changed.connect(clear_trust_resolver)
@@ -6,6 +6,17 @@ try:
     from django.utils.timezone import now as nowfn
 except ImportError:
     nowfn = datetime.datetime.now
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed  # noqa
+try:
+    from django.core.cache import caches
+except ImportError:
+    from django.core.cache import get_cache
+else:
+    def get_cache(alias):
+        return caches[alias]
 
 
 def load_path_attr(path):
@@ -1,44 +1,60 @@
+import json
+import time
 import urlparse
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.contrib.auth.decorators import user_passes_test
 from django.http import HttpResponse, HttpResponseRedirect
+from django.utils.html import escape
 from django.views.decorators.csrf import csrf_exempt
-from django.views.generic import TemplateView
+from django.views.generic import TemplateView, View
 from django.views.generic.edit import FormView
 from django.utils.decorators import method_decorator
 
 from openid.consumer.discover import OPENID_IDP_2_0_TYPE
 from openid.extensions import sreg
-from openid.server.server import Server
+from openid.message import InvalidOpenIDNamespace, Message
 from openid.server.server import EncodingError, ProtocolError
 from openid.yadis.constants import YADIS_CONTENT_TYPE
 
+from identeco.discovery import conditional_response, documents, make_etag
 from identeco.forms import TrustForm
+from identeco.instrumentation import phase, phase_stats
 from identeco.models import Trust
+from identeco.profiling import request_profiler
+from identeco.ratelimit import rate_limiter
+from identeco.registry import registry
+from identeco.trust import trust_resolver
 from identeco.utils import load_path_attr
 
 
 LOGIN_REQUIRED = getattr(settings, "IDENTECO_LOGIN_REQUIRED", "django.contrib.auth.decorators.login_required")
+DISCOVERY_CACHE_CONTROL = "public, max-age={0}".format(getattr(settings, "IDENTECO_DISCOVERY_MAX_AGE", 3600))
+LOCAL_ID_PLACEHOLDER = "IDENTECO-LOCAL-ID"
 
 
 class OpenIDView(object):
 
+    def dispatch(self, request, *args, **kwargs):
+        dispatch = super(OpenIDView, self).dispatch
+        return request_profiler.profile(request, self, lambda: dispatch(request, *args, **kwargs))
+
     def get_openid_store(self):
-        store = getattr(settings, "IDENTECO_STORE", "identeco.store.DjangoORMStore")
-        return load_path_attr(store)()
+        return registry.get_store()
 
     def get_openid_endpoint(self):
         return self.request.build_absolute_uri(reverse("identeco_endpoint"))
 
     def get_openid_server(self):
-        return Server(self.get_openid_store(), self.get_openid_endpoint())
+        return registry.get_server(self.get_openid_endpoint())
 
     def render_openid_response(self, openid_response):
         if not hasattr(self, "server"):
             self.server = self.get_openid_server()
         try:
-            webresponse = self.server.encodeResponse(openid_response)
+            with phase("encode_response"):
+                webresponse = self.server.encodeResponse(openid_response)
         except EncodingError as e:
             self.template_name = self.template_names["error"]
             return self.render_to_response({"error": e.response.encodeToKVForm()})
@@ -51,11 +67,15 @@ class OpenIDView(object):
 
 class OpenIDUserData(object):
 
+    def get_claims(self, user, fields):
+        if not fields:
+            return {}
+        return registry.get_claims_provider().get_claims(user, fields)
+
     def add_sreg(self, request, response, user):
         sreg_req = sreg.SRegRequest.fromOpenIDRequest(request)
-        sreg_data = {
-            "nickname": user.username,
-        }
+        # Only load the fields the relying party asked for.
+        sreg_data = self.get_claims(user, sreg_req.allRequestedFields())
         sreg_resp = sreg.SRegResponse.extractResponse(sreg_req, sreg_data)
         response.addExtension(sreg_resp)
 
@@ -65,17 +85,25 @@ class DecideTrust(OpenIDView, OpenIDUserData, FormView):
     form_class = TrustForm
     template_name = "identeco/trust/decide.html"
 
+    def get_openid_request(self):
+        # The session only holds the request's OpenID message args, decode
+        # them once per request.
+        if not hasattr(self, "openid_request"):
+            args = self.request.session.get("openid_request")
+            self.openid_request = self.get_openid_server().decodeRequest(args) if args else None
+        return self.openid_request
+
     def get_initial(self):
         initial = super(DecideTrust, self).get_initial()
         initial.update({
-            "trust_root": self.request.session.get("openid_request").trust_root,
+            "trust_root": self.get_openid_request().trust_root,
         })
         return initial
 
     def get_form_kwargs(self):
         kwargs = super(DecideTrust, self).get_form_kwargs()
         kwargs.update({
-            "openid_request": self.request.session.get("openid_request"),
+            "openid_request": self.get_openid_request(),
         })
         return kwargs
 
@@ -87,7 +115,7 @@ class DecideTrust(OpenIDView, OpenIDUserData, FormView):
                 defaults={"always_trust": form.cleaned_data["always_trust"]}
             )
         identity = self.request.build_absolute_uri(reverse("identeco_identity", kwargs={"username": self.request.user.username}))
-        openid_request = self.request.session.get("openid_request")
+        openid_request = self.get_openid_request()
         if self.request.POST.get("allow"):
             openid_response = openid_request.answer(True, identity=identity)
             self.add_sreg(openid_request, openid_response, self.request.user)
@@ -97,18 +125,9 @@ class DecideTrust(OpenIDView, OpenIDUserData, FormView):
 
     def get(self, request, *args, **kwargs):
         identity = self.request.build_absolute_uri(reverse("identeco_identity", kwargs={"username": self.request.user.username}))
-        openid_request = self.request.session.get("openid_request")
+        openid_request = self.get_openid_request()
         url = urlparse.urlparse(openid_request.trust_root)
-        trusted_domains = getattr(settings, "IDENTECO_TRUSTED_DOMAINS", [])
-        if url.hostname in trusted_domains:
-            trusted = True
-        else:
-            try:
-                t = Trust.objects.get(user=self.request.user, trust_root=openid_request.trust_root)
-            except Trust.DoesNotExist:
-                trusted = False
-            else:
-                trusted = t.always_trust
+        trusted = trust_resolver.is_trusted(self.request.user, openid_request.trust_root, hostname=url.hostname)
         if trusted:
             openid_response = openid_request.answer(True, identity=identity)
             self.add_sreg(openid_request, openid_response, self.request.user)
@@ -129,38 +148,49 @@ class Endpoint(OpenIDView, OpenIDUserData, TemplateView):
     }
 
     def handle_checkid(self):
-        # @@@ Do Something with self.openid_request.idSelect()
-        print "~>", self.openid_request.idSelect()
-        if self.openid_request.immediate:
-            if self.request.user.is_authorized():
-                try:
-                    t = Trust.objects.get(user=self.request.user, trust_root=self.openid_request.trust_root)
-                    if t.always_trust:
+        with phase("handle_checkid"):
+            # @@@ Do Something with self.openid_request.idSelect()
+            if self.openid_request.immediate:
+                if self.request.user.is_authenticated():
+                    url = urlparse.urlparse(self.openid_request.trust_root)
+                    with phase("trust_lookup"):
+                        trusted = trust_resolver.is_trusted(self.request.user, self.openid_request.trust_root, hostname=url.hostname)
+                    if trusted:
                         identity = self.request.build_absolute_uri(reverse("identeco_identity", kwargs={"username": self.request.user.username}))
                         openid_response = self.openid_request.answer(True, identity=identity)
                         self.add_sreg(self.openid_request, openid_response, self.request.user)
                         return self.render_openid_response(openid_response)
-                except Trust.DoesNotExist:
-                    pass
-            return self.render_openid_response(self.openid_request.answer(False))
-        else:
-            self.request.session["openid_request"] = self.openid_request
-            return HttpResponseRedirect(reverse("identeco_decide_trust"))
+                return self.render_openid_response(self.openid_request.answer(False))
+            else:
+                with phase("session_update"):
+                    self.request.session["openid_request"] = self.openid_request.message.toPostArgs()
+                return HttpResponseRedirect(reverse("identeco_decide_trust"))
 
     def process_openid_request(self, data):
-        self.server = self.get_openid_server()
-        try:
-            self.openid_request = self.server.decodeRequest(data)
-        except ProtocolError as e:
-            self.template_name = self.template_names["error"]
-            return self.render_to_response({"error": str(e)})
-        if self.openid_request is None:
-            self.template_name = self.template_names["empty"]
-            return self.render_to_response({})
-        if self.openid_request.mode in ["checkid_immediate", "checkid_setup"]:
-            return self.handle_checkid()
-        else:
-            return self.render_openid_response(self.server.handleRequest(self.openid_request))
+        with phase("process_openid_request"):
+            self.server = self.get_openid_server()
+            try:
+                message = Message.fromPostArgs(data)
+            except InvalidOpenIDNamespace:
+                # decodeRequest reports it
+                message = None
+            if message is not None and not rate_limiter.allow(self.request, message):
+                return self.render_openid_response(ProtocolError(message, "Rate limit exceeded"))
+            try:
+                with phase("decode_request"):
+                    self.openid_request = self.server.decodeRequest(data)
+            except ProtocolError as e:
+                self.template_name = self.template_names["error"]
+                return self.render_to_response({"error": str(e)})
+            if self.openid_request is None:
+                self.template_name = self.template_names["empty"]
+                return self.render_to_response({})
+            if self.openid_request.mode in ["checkid_immediate", "checkid_setup"]:
+                return self.handle_checkid()
+            else:
+                with phase("handle_request"):
+                    openid_response = self.server.handleRequest(self.openid_request)
+                return self.render_openid_response(openid_response)
 
     def get(self, request, *args, **kwargs):
         return self.process_openid_request(request.GET.dict())
@@ -186,18 +216,50 @@ class XRDS(TemplateView):
     def get_endpoint_uris(self):
         return [self.request.build_absolute_uri(reverse("identeco_endpoint"))] + getattr(settings, "IDENTECO_EXTRA_ENDPOINTS", [])
 
+    def get_local_id(self):
+        if not self.identity:
+            return None
+        return self.request.build_absolute_uri(reverse("identeco_identity", kwargs={"username": self.kwargs["username"]}))
+
     def get_context_data(self, **kwargs):
         ctx = super(XRDS, self).get_context_data(**kwargs)
         ctx.update({
             "type_uris": self.get_type_uris(),
             "endpoint_uris": self.get_endpoint_uris(),
-            "local_id": None if not self.identity else self.request.build_absolute_uri(reverse("identeco_identity", kwargs={"username": self.kwargs["username"]})),
+            "local_id": self.get_local_id(),
         })
         return ctx
 
+    def render_document(self, **kwargs):
+        # Identity documents only differ in the username's LocalID, render the
+        # template once per host with a placeholder for it.
+        key = ("xrds_template", self.request.is_secure(), self.request.get_host(), self.identity)
+        content = documents.get(key)
+        if content is None:
+            context = self.get_context_data(**kwargs)
+            if self.identity:
+                context["local_id"] = LOCAL_ID_PLACEHOLDER
+            content = self.response_class(self.request, self.get_template_names(), context).render().content
+            documents.set(key, content)
+        if self.identity:
+            content = content.replace(LOCAL_ID_PLACEHOLDER, escape(self.get_local_id()).encode("utf-8"))
+        return content
+
+    def get_document(self, **kwargs):
+        # The document only depends on the host and the username, keep it
+        # with its ETag so neither is computed per request.
+        username = self.kwargs["username"] if self.identity else None
+        key = ("xrds", self.request.is_secure(), self.request.get_host(), username)
+        document = documents.get(key)
+        if document is None:
+            content = self.render_document(**kwargs)
+            document = (content, time.time(), make_etag(content))
+            documents.set(key, document)
+        return document
+
     def get(self, request, *args, **kwargs):
-        context = self.get_context_data(**kwargs)
-        return self.render_to_response(context, content_type=YADIS_CONTENT_TYPE)
+        content, last_modified, etag = self.get_document(**kwargs)
+        return conditional_response(request, content, last_modified, DISCOVERY_CACHE_CONTROL, content_type=YADIS_CONTENT_TYPE, etag=etag)
 
 
 class Identity(TemplateView):
@@ -209,3 +271,18 @@ class Identity(TemplateView):
             "username": self.kwargs.get("username"),
         })
         return ctx
+
+    def get(self, request, *args, **kwargs):
+        response = super(Identity, self).get(request, *args, **kwargs).render()
+        # The page shows the logged in user, so it must not be shared.
+        return conditional_response(request, response.content, None, "private", content_type=response["Content-Type"])
+
+
+class Stats(View):
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(json.dumps(phase_stats.snapshot(), indent=2, sort_keys=True), content_type="application/json")
+
+    @method_decorator(user_passes_test(lambda user: user.is_staff))
+    def dispatch(self, *args, **kwargs):
+        return super(Stats, self).dispatch(*args, **kwargs)
@@ -119,7 +119,7 @@ setup(
     author_email=AUTHOR_EMAIL,
     license="BSD",
     url=URL,
-    packages=find_packages(exclude=["tests.*", "tests"]),
+    packages=find_packages(exclude=["tests.*", "tests", "benchmarks.*", "benchmarks"]),
     package_data=find_package_data(PACKAGE, only_in_packages=False),
     classifiers=[
         "Environment :: Web Environment",